@@ -0,0 +1,547 @@
+#!/usr/bin/python3
+
+import argparse
+import datetime
+import importlib
+import json
+import os
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import types
+
+#################################
+############# USAGE #############
+#################################
+
+# Runs sheetarr offline against fake google sheets, sonarr and radarr clients, and reports the time, api calls,
+# sheets quota used and peak memory of each phase
+# python3 benchmark.py --rows 1000 --sheets 12 --series 5000 --movies 5000
+# Checks the title resolver against known cases before measuring
+# Record the generated data with --record DIR, and replay recorded or edited data with --fixtures DIR
+# DIR holds spreadsheet.json (a _spreadsheets_get response), series.json, movies.json and lookups.json
+
+
+#################################
+############ FIXTURES ###########
+#################################
+
+words = ['the', 'last', 'house', 'of', 'dragon', 'office', 'night', 'star', 'blue', 'lost', 'city', 'river',
+         'king', 'queen', 'game', 'dark', 'iron', 'silver', 'ghost', 'garden', 'mountain', 'machine', 'storm']
+
+
+def RandomTitle(rng, used):
+    """Get a new random title made of words"""
+    while True:
+        title = ' '.join(rng.choice(words) for _ in range(rng.randint(2, 4))).title()
+        if title.lower() not in used:
+            used.add(title.lower())
+            return title
+
+
+def MakeSeries(rng, count):
+    """Make a sonarr library of series with season statistics"""
+    used = set()
+    library = []
+    for index in range(count):
+        seasons = []
+        for seasonNumber in range(1, rng.randint(2, 30)):
+            totalEpisodes = rng.randint(6, 24)
+            fileCount = rng.randint(0, totalEpisodes)
+            seasons.append({'seasonNumber': seasonNumber, 'statistics': {
+                'episodeFileCount': fileCount, 'totalEpisodeCount': totalEpisodes, 'sizeOnDisk': fileCount * 1500000000}})
+        title = RandomTitle(rng, used)
+        library.append({
+            'id': index + 1, 'title': title, 'year': rng.randint(1960, 2024), 'tvdbId': 100000 + index,
+            'titleSlug': title.lower().replace(' ', '-'), 'status': rng.choice(['continuing', 'ended']),
+            'qualityProfileId': rng.choice([4, 4, 4, 5]), 'alternateTitles': [], 'seasons': seasons,
+            'statistics': {
+                'episodeFileCount': sum(season['statistics']['episodeFileCount'] for season in seasons),
+                'episodeCount': sum(season['statistics']['totalEpisodeCount'] for season in seasons),
+                'sizeOnDisk': sum(season['statistics']['sizeOnDisk'] for season in seasons)}
+        })
+    return library
+
+
+def MakeMovies(rng, count):
+    """Make a radarr library of movies with files"""
+    used = set()
+    library = []
+    for index in range(count):
+        title = RandomTitle(rng, used)
+        hasFile = rng.random() < 0.8
+        library.append({
+            'id': index + 1, 'title': title, 'year': rng.randint(1960, 2024), 'tmdbId': 200000 + index,
+            'titleSlug': title.lower().replace(' ', '-'), 'status': 'released', 'qualityProfileId': rng.choice([4, 4, 4, 5]),
+            'alternateTitles': [], 'hasFile': hasFile, 'sizeOnDisk': hasFile and rng.randint(1, 60) * 1000000000 or 0,
+            'movieFile': {'quality': {'quality': {'resolution': rng.choice([720, 1080, 1080, 2160])}}}
+        })
+    return library
+
+
+def Typo(rng, title):
+    """Misspell a title by swapping two letters"""
+    index = rng.randint(0, len(title) - 2)
+    return title[:index] + title[index + 1] + title[index] + title[index + 2:]
+
+
+def MakeSpreadsheet(rng, series, movies, sheetCount, rowCount, unmatched):
+    """Make a _spreadsheets_get response with user sheets of series and movies, and an Info sheet"""
+    sheets = []
+    for sheetIndex in range(sheetCount):
+        rowData = [{'values': [{'formattedValue': 'Series'}, {}, {}, {'formattedValue': 'Movies'}, {}, {}]}]
+        for _ in range(rowCount):
+            values = []
+            for library in (series, movies):
+                title = rng.choice(library)['title']
+                if rng.random() < unmatched:
+                    title = Typo(rng, title)
+                values += [{'formattedValue': title}, {'formattedValue': rng.choice(['1080p', '1080p', '2160p'])}, {}]
+            rowData.append({'values': values})
+        sheets.append({
+            'properties': {'sheetId': sheetIndex + 1, 'title': 'User ' + str(sheetIndex + 1),
+                           'gridProperties': {'rowCount': rowCount + 1, 'columnCount': 6}},
+            'data': [{'rowData': rowData}]
+        })
+    sheets.append({
+        'properties': {'sheetId': 0, 'title': 'Info',
+                       'gridProperties': {'rowCount': max(len(series), len(movies)) + 5, 'columnCount': 4}},
+        'data': [{'rowData': []}]
+    })
+    return {'sheets': sheets}
+
+
+def MakeLookups(rng, spreadsheet, series, movies):
+    """Make search results for every title on the sheets that isn't in the libraries"""
+    titles = {True: {item['title'].lower() for item in series}, False: {item['title'].lower() for item in movies}}
+    lookups = {}
+    for sheet in spreadsheet['sheets']:
+        for row in sheet['data'][0]['rowData'][1:]:
+            for isSeries, column in ((True, 0), (False, 3)):
+                title = row['values'][column].get('formattedValue', '')
+                if title.lower() not in titles[isSeries]:
+                    found = rng.choice(isSeries and series or movies)
+                    lookups[(isSeries and 'series:' or 'movie:') + title.lower()] = [
+                        {'title': found['title'], 'year': found['year'], 'tvdbId': found.get('tvdbId'), 'tmdbId': found.get('tmdbId')}]
+    return lookups
+
+
+def LoadFixtures(args):
+    """Load the fixtures from a directory, or generate them at the given scale"""
+    if args.fixtures:
+        fixtures = {}
+        for name in ['spreadsheet', 'series', 'movies', 'lookups']:
+            with open(os.path.join(args.fixtures, name + '.json')) as json_file:
+                fixtures[name] = json.load(json_file)
+        return fixtures
+
+    rng = random.Random(args.seed)
+    series = MakeSeries(rng, args.series)
+    movies = MakeMovies(rng, args.movies)
+    spreadsheet = MakeSpreadsheet(rng, series, movies, args.sheets, args.rows, args.unmatched)
+    fixtures = {'spreadsheet': spreadsheet, 'series': series, 'movies': movies,
+                'lookups': MakeLookups(rng, spreadsheet, series, movies)}
+    if args.record:
+        os.makedirs(args.record, exist_ok=True)
+        for name, data in fixtures.items():
+            with open(os.path.join(args.record, name + '.json'), 'w') as json_file:
+                json.dump(data, json_file)
+    return fixtures
+
+
+#################################
+############# FAKES #############
+#################################
+
+# Number of calls made to each fake api, e.g. sheets.read
+apiCalls = {}
+callsLock = threading.Lock()
+# Seconds each fake sheets request takes, set with --latency
+sheetsLatency = 0
+
+
+def CountCall(name):
+    """Count a call to a fake api"""
+    with callsLock:
+        apiCalls[name] = apiCalls.get(name, 0) + 1
+
+
+class FakeWorksheet:
+    """A worksheet of the fake spreadsheet"""
+
+    def __init__(self, spreadsheet, sheetId, title, rowCount):
+        self.spreadsheet = spreadsheet
+        self.id = sheetId
+        self.title = title
+        self.row_count = rowCount
+
+
+class FakeSpreadsheet:
+    """A spreadsheet that serves and applies writes to a _spreadsheets_get response held in memory"""
+
+    def __init__(self, data):
+        self.id = 'benchmark'
+        self.title = 'Benchmark'
+        self.sheets = data['sheets']
+
+    def worksheets(self):
+        CountCall('sheets.read')
+        return [FakeWorksheet(self, sheet['properties']['sheetId'], sheet['properties']['title'],
+                              sheet['properties']['gridProperties']['rowCount']) for sheet in self.sheets]
+
+    def _spreadsheets_get(self, params):
+        CountCall('sheets.read')
+        time.sleep(sheetsLatency)
+        sheetsByTitle = {sheet['properties']['title']: sheet for sheet in self.sheets}
+        response = {}
+        for sheetRange in params['ranges']:
+            title, cells = re.match(r"'(.*)'!(.*)", sheetRange).groups()
+            title = title.replace("''", "'")
+            start, end = cells.split(':')
+            startColumn, startRow = ColumnIndex(start), RowNumber(start, 1) - 1
+            endColumn, endRow = ColumnIndex(end), RowNumber(end, 0)
+            sheet = sheetsByTitle[title]
+            rowData = sheet['data'][0]['rowData']
+            rows = [{'values': row.get('values', [])[startColumn:endColumn + 1]}
+                    for row in rowData[startRow:endRow or len(rowData)]]
+            if title not in response:
+                response[title] = {'properties': sheet['properties'], 'data': []}
+            response[title]['data'].append({'startRow': startRow, 'startColumn': startColumn, 'rowData': rows})
+        return {'sheets': list(response.values())}
+
+    def batch_update(self, body):
+        CountCall('sheets.write')
+        time.sleep(sheetsLatency)
+        sheetsById = {sheet['properties']['sheetId']: sheet for sheet in self.sheets}
+        for request in body['requests']:
+            update = request['updateCells']
+            rowData = sheetsById[update['start']['sheetId']]['data'][0]['rowData']
+            for y, row in enumerate(update['rows']):
+                rowIndex = update['start']['rowIndex'] + y
+                while len(rowData) <= rowIndex:
+                    rowData.append({})
+                values = rowData[rowIndex].setdefault('values', [])
+                for x, cellData in enumerate(row['values']):
+                    columnIndex = update['start']['columnIndex'] + x
+                    while len(values) <= columnIndex:
+                        values.append({})
+                    ApplyCell(values[columnIndex], cellData, update['fields'].split(','))
+
+
+def ColumnIndex(cell):
+    """Get the zero based column of a cell, e.g. C5 -> 2"""
+    index = 0
+    for letter in cell.rstrip('0123456789'):
+        index = index * 26 + ord(letter) - 64
+    return index - 1
+
+
+def RowNumber(cell, default):
+    """Get the row number of a cell, or default if it has none, e.g. C5 -> 5, C -> default"""
+    digits = cell[len(cell.rstrip('0123456789')):]
+    return digits and int(digits) or default
+
+
+def ApplyCell(cell, cellData, fields):
+    """Apply an updateCells write to a cell as the sheets api would read it back"""
+    if 'userEnteredValue' in fields:
+        cell.pop('formattedValue', None)
+        cell.pop('hyperlink', None)
+        value = cellData.get('userEnteredValue', {})
+        if 'formulaValue' in value:
+            link = re.match(r'=HYPERLINK\("(.*)", "(.*)"\)', value['formulaValue'])
+            if link:
+                cell['hyperlink'], cell['formattedValue'] = link.groups()
+        elif value.get('stringValue', '') != '':
+            cell['formattedValue'] = value['stringValue']
+        if cell.get('hyperlink') == '':
+            cell.pop('hyperlink')
+    if 'note' in fields:
+        cell.pop('note', None)
+        if cellData.get('note', '') != '':
+            cell['note'] = cellData['note']
+    if 'userEnteredFormat.textFormat' in fields:
+        colour = cellData['userEnteredFormat']['textFormat']['foregroundColor']
+        cell['userEnteredFormat'] = {'textFormat': {'foregroundColorStyle': {
+            'rgbColor': {key: value for key, value in colour.items() if value}}}}
+
+
+class FakeClient:
+    """A gspread client that opens the fake spreadsheet"""
+
+    def __init__(self, spreadsheet):
+        self.spreadsheet = spreadsheet
+        self.session = FakeSession()
+
+    def open(self, name):
+        return self.spreadsheet
+
+
+class FakeArr:
+    """A pyarr sonarr/radarr api serving the fixture library and search results"""
+
+    def __init__(self, site, library, lookups):
+        self.site = site
+        self.library = library
+        self.lookups = lookups
+        self.auth = None
+
+    def basic_auth(self, username, password):
+        return None
+
+    def Call(self, name, result):
+        CountCall(self.site + '.' + name)
+        return result
+
+    def get_series(self, *args):
+        return self.Call('get_series', self.library)
+
+    def get_movie(self, *args):
+        return self.Call('get_movie', self.library)
+
+    def lookup_series(self, term):
+        return self.Call('lookup_series', self.lookups.get('series:' + term.lower(), []))
+
+    def lookup_movie(self, term):
+        return self.Call('lookup_movie', self.lookups.get('movie:' + term.lower(), []))
+
+    def add_series(self, **kwargs):
+        return self.Call('add_series', None)
+
+    def add_movie(self, *args, **kwargs):
+        return self.Call('add_movie', None)
+
+    def upd_series(self, data):
+        return self.Call('upd_series', data)
+
+    def upd_movie(self, data):
+        return self.Call('upd_movie', data)
+
+
+class FakeResponse:
+    """A response from the fake http session"""
+
+    def __init__(self, data):
+        self.status_code = 200
+        self.headers = {}
+        self.data = data
+        self.content = json.dumps(data).encode()
+
+    def json(self):
+        return self.data
+
+    def raise_for_status(self):
+        pass
+
+
+class FakeSession:
+    """A requests session for sonarr/radarr and discord, serving library items by id, with nothing new in the history"""
+
+    def __init__(self, fixtures=None):
+        self.items = {}
+        for path, key in (('series/', 'series'), ('movie/', 'movies')):
+            for item in (fixtures or {}).get(key, []):
+                self.items[path + str(item['id'])] = item
+
+    def request(self, method, url, **kwargs):
+        CountCall('http.' + method.lower())
+        return FakeResponse(method == 'GET' and self.items.get(url.split('/api/v3/')[-1], []) or {})
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def mount(self, prefix, adapter):
+        pass
+
+
+class FakeCredentials:
+    """Google service account credentials with a token that lasts an hour"""
+
+    def __init__(self):
+        self.token = None
+        self.expiry = None
+
+    @property
+    def valid(self):
+        return self.token is not None and self.expiry > datetime.datetime.utcnow()
+
+    def refresh(self, request):
+        CountCall('sheets.token')
+        self.token = 'token'
+        self.expiry = datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+
+
+def InstallFakes(fixtures):
+    """Install the fake gspread, google auth and pyarr modules for sheetarr to import, returns the fake spreadsheet"""
+    spreadsheet = FakeSpreadsheet(fixtures['spreadsheet'])
+
+    gspread = types.ModuleType('gspread')
+    gspread.authorize = lambda creds: FakeClient(spreadsheet)
+    gspread.exceptions = types.SimpleNamespace(APIError=type('APIError', (Exception,), {}))
+
+    serviceAccount = types.ModuleType('google.oauth2.service_account')
+    serviceAccount.Credentials = types.SimpleNamespace(
+        from_service_account_file=lambda keyfile, scopes: FakeCredentials())
+    transport = types.ModuleType('google.auth.transport.requests')
+    transport.Request = lambda session: None
+
+    pyarr = types.ModuleType('pyarr')
+    pyarr.SonarrAPI = lambda url, api: FakeArr('sonarr', fixtures['series'], fixtures['lookups'])
+    pyarr.RadarrAPI = lambda url, api: FakeArr('radarr', fixtures['movies'], fixtures['lookups'])
+
+    sys.modules.update({'gspread': gspread, 'google.oauth2.service_account': serviceAccount,
+                        'google.auth.transport.requests': transport, 'pyarr': pyarr})
+    return spreadsheet
+
+
+#################################
+############# CHECKS ############
+#################################
+
+# Names the title resolver must match right, with the library titles and years, and the title and year it should accept or None
+resolverCases = [
+    ('Breakign Bad', [('Breaking Bad', 2008)], 'Breaking Bad 2008'),
+    ('The Ofice 2005', [('The Office', 2001), ('The Office', 2005)], 'The Office 2005'),
+    # A remake asked for by year is never matched to the older series/movie
+    ('Dune 2021', [('Dune', 1984)], None),
+    ('The Office 2005', [('The Office', 2001)], None),
+]
+
+
+def CheckResolver(sheetarr):
+    """Check the title resolver against resolverCases, raising AssertionError at the first wrong match"""
+    for name, titles, expected in resolverCases:
+        library = [{'title': title, 'year': year, 'alternateTitles': []} for title, year in titles]
+        match = sheetarr.BestMatch(name, library)
+        matched = match and match['title'] + ' ' + str(match['year'])
+        assert matched == expected, name + ' matched ' + str(matched) + ', expected ' + str(expected)
+
+
+def CheckRefresh(sheetarr, spreadsheet):
+    """Check a sonarr webhook refresh rewrites the series cells of its rows and leaves the movie cells untouched"""
+    instance = sheetarr.Instances(True)[0]
+    site, itemId = [key for key in sheetarr.sheetMediaRows if key[0] == instance['name']][0]
+    sheetsById = {sheet['properties']['sheetId']: sheet for sheet in spreadsheet.sheets}
+    rows = [sheetsById[gsheet.id]['data'][0]['rowData'][rowIndex]
+            for gsheet, rowIndex in sheetarr.sheetMediaRows[(site, itemId)]]
+    movieCells = json.dumps([row['values'][3:6] for row in rows])
+    # Clear the status cell so the refresh has a series cell to write
+    for row in rows:
+        row['values'][2] = {}
+    sheetarr.RefreshMedia(instance, itemId, False)
+    assert all(row['values'][2] for row in rows), 'series event did not refresh the series cells'
+    assert json.dumps([row['values'][3:6] for row in rows]) == movieCells, 'series event changed the movie cells'
+
+
+#################################
+############ MEASURE ############
+#################################
+
+def RunPhase(name, function):
+    """Run a phase, returning its wall time, peak memory, api calls, quota used and the time sheetarr recorded in each of its phases"""
+    sheetarr = sys.modules.get('sheetarr')
+    apiCalls.clear()
+    if sheetarr:
+        sheetarr.phaseTimes.clear()
+        sheetarr.lastRun.clear()
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    function()
+    wallTime = time.perf_counter() - start
+    peakMemory = tracemalloc.get_traced_memory()[1]
+    # Whole syncs move their phase times to lastRun when they finish
+    phaseTimes = sheetarr and (sheetarr.lastRun.get('phases') or sheetarr.phaseTimes) or {}
+    return {
+        'phase': name,
+        'seconds': round(wallTime, 3),
+        'peakMiB': round(peakMemory / 1024 / 1024, 1),
+        'quotaUnits': apiCalls.get('sheets.read', 0) + apiCalls.get('sheets.write', 0),
+        'apiCalls': dict(apiCalls),
+        'phaseSeconds': {key: round(value, 3) for key, value in phaseTimes.items()}
+    }
+
+
+def PrintReport(results):
+    """Print the results of each phase"""
+    for result in results:
+        print('{phase:<10} {seconds:>9.3f}s {peakMiB:>8.1f}MiB {quotaUnits:>6} quota'.format(**result))
+        for key, value in sorted(result['apiCalls'].items()):
+            print('    ' + key.ljust(24) + str(value).rjust(8))
+        for key, value in sorted(result['phaseSeconds'].items()):
+            print('    ' + key.ljust(24) + ('%.3fs' % value).rjust(8))
+
+
+def Main():
+    parser = argparse.ArgumentParser(description='Benchmark sheetarr against fake services')
+    parser.add_argument('--rows', type=int, default=1000, help='rows on each user sheet')
+    parser.add_argument('--sheets', type=int, default=4, help='number of user sheets')
+    parser.add_argument('--series', type=int, default=5000, help='series in the sonarr library')
+    parser.add_argument('--movies', type=int, default=5000, help='movies in the radarr library')
+    parser.add_argument('--unmatched', type=float, default=0.02, help='fraction of titles that are misspelled')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the generated data')
+    parser.add_argument('--fixtures', help='directory to load recorded data from instead of generating it')
+    parser.add_argument('--record', help='directory to save the generated data to')
+    parser.add_argument('--json', help='file to write the results to as json')
+    parser.add_argument('--sync', action='store_true', help='run whole syncs as sheetarr does, rather than each stage')
+    parser.add_argument('--stream', action='store_true', help='sync a page of rows at a time as with sheetarr --stream')
+    parser.add_argument('--latency', type=float, default=0, help='seconds each sheets request takes')
+    args = parser.parse_args()
+    global sheetsLatency
+    sheetsLatency = args.latency
+
+    fixtures = LoadFixtures(args)
+    spreadsheet = InstallFakes(fixtures)
+
+    # Run from a scratch directory so the cache database starts empty
+    scriptDirectory = os.path.dirname(os.path.abspath(__file__))
+    workDirectory = tempfile.mkdtemp(prefix='sheetarr-benchmark-')
+    os.chdir(workDirectory)
+    with open('credentials.json', 'w') as json_file:
+        json.dump({
+            'sheet': {'keyfile': 'keyfile.json', 'sheetname': 'Benchmark'},
+            'sonarr': {'url': 'http://sonarr', 'api': 'key', 'authuser': '', 'authpass': ''},
+            'radarr': {'url': 'http://radarr', 'api': 'key', 'authuser': '', 'authpass': ''},
+            'discord': 'http://discord'
+        }, json_file)
+    sys.path.insert(0, scriptDirectory)
+
+    tracemalloc.start()
+    results = []
+    results.append(RunPhase('import', lambda: importlib.import_module('sheetarr')))
+    sheetarr = sys.modules['sheetarr']
+    CheckResolver(sheetarr)
+
+    # Keep the quota from sleeping, and keep requests and discord offline
+    sheetarr.sheetsQuota, sheetarr.sheetsQuotaBurst = 2 * 10 ** 9, 10 ** 9
+    sheetarr.discordVerbosity = 0
+    engine = sheetarr.SheetarrEngine(stream=args.stream)
+    results.append(RunPhase('config', engine.LoadConfig))
+    sheetarr.arrSession = sheetarr.discordSession = FakeSession(fixtures)
+
+    # The first run downloads everything, the second only the changes and should find the sheets up to date
+    for prefix in ['', 're']:
+        if args.sync or args.stream:
+            # Syncs read, process and write together, so run as one phase
+            results.append(RunPhase(prefix + 'sync', engine.Sync))
+            continue
+        results.append(RunPhase(prefix + 'fetch', engine.Fetch))
+        results.append(RunPhase(prefix + 'plan', engine.Plan))
+        results.append(RunPhase(prefix + 'apply', engine.Apply))
+    tracemalloc.stop()
+    CheckRefresh(sheetarr, spreadsheet)
+
+    PrintReport(results)
+    if args.json:
+        with open(os.path.join(scriptDirectory, args.json), 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    Main()
@@ -1,18 +1,24 @@
 #!/usr/bin/python3
 
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
-
 import json
 import time
+import inspect
+import re
 import os
 import string
-import pyarr
 from colorama import Fore, Style
-import requests
 import datetime
-import titlecase
 import sys
+import hashlib
+import hmac
+import base64
+import sqlite3
+import random
+import signal
+import threading
+import queue
+import http.server
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 #################################
 ############# TODOS #############
@@ -23,7 +29,6 @@ import sys
 # If sonarr, radarr or spreadsheet data file is missing, prompt user to provide the information
 # Make discord optional and add readme info about it
 # Run arguments to change information stored
-# --help argument to display help
 
 # Setup command which creates the spreadsheet with correct blank format
 
@@ -43,39 +48,376 @@ import sys
 # Manage auto run at 20 minute intervals with
 # crontab -e
 # */20 * * * * /DIRECTORY/run_sheetsmanager.sh
+# Or keep it running with python3 sheetarr.py --daemon, optionally with --interval SECONDS and --jitter SECONDS
+
+# Seconds between syncs in daemon mode, and the most random extra delay added to each
+daemonInterval = 20 * 60
+daemonJitter = 30
+
+# Seconds to reuse sonarr/radarr search results for, including searches that found nothing
+lookupCacheTime = 24 * 60 * 60
+# Seconds to remember sent discord messages for, they are only sent once per day
+discordHistoryTime = 2 * 24 * 60 * 60
+
+# Google sheets read and write requests allowed per minute per user, and how many can be sent at once
+# Syncs running at the same time share these through the cache database
+sheetsQuota = 60
+sheetsQuotaBurst = 10
+# Times to retry a sheets request that was throttled or failed with a server error
+sheetsRetries = 6
+
+# Discord messages to send, 0 for none, 1 for adds, changes and failures, 2 to also send every cell written
+discordVerbosity = 2
+# Seconds to wait for more discord messages to send together, up to 10 are sent in one message
+discordBatchDelay = 2
+# Times to retry a discord message that was rate limited before dropping it, and seconds to wait for messages to send before exiting
+discordRetries = 5
+discordExitWait = 60
+
+# Seconds between full downloads of the sonarr/radarr libraries, between them only items with new history are downloaded
+libraryFullRefreshTime = 6 * 60 * 60
+
+# Seconds to wait to connect to, and then hear back from, google sheets, sonarr, radarr and discord before giving up
+httpTimeout = (10, 60)
+# Connections kept open to each host for reuse between requests
+httpPoolSize = 10
+
+# Number of sonarr/radarr searches to run at once
+lookupWorkers = 4
+# Number of users sheets of a spreadsheet to process at once
+sheetWorkers = 4
+
+# Seconds between refreshes of the info sheet, 0 to refresh it every sync
+infoRefreshTime = 0
+
+# Port to accept sonarr/radarr webhooks on in daemon mode, 0 to disable, or set with --webhook PORT
+# Add a webhook connection in sonarr/radarr to http://HOST:PORT/NAME for On Grab, On Download and On Delete
+# NAME is the instances name in credentials.json, or left out for the first instance
+# Test locally with curl -d '{"eventType": "Download", "series": {"id": 1}}' http://localhost:PORT/
+webhookPort = 0
+# Address to accept webhooks on, 127.0.0.1 for this machine only, '' for every address, or set with --webhook-host HOST
+# When sonarr/radarr are on another machine, add "webhook": {"authuser": "", "authpass": ""} to credentials.json
+# and set the same username and password on the webhook connections, so only they can trigger refreshes
+webhookHost = '127.0.0.1'
+
+# Links to series/movies on sonarr/radarr, used unless an instance in credentials.json has its own "link"
+sonarrLink = 'http://sonarr.ratatoskr.uk/series/'
+radarrLink = 'http://radarr.ratatoskr.uk/movie/'
 
 # Should the resolution be pulled from the sites or pushed to them
 shouldPullResolution = False
 
+# File --plan saves the planned changes to, unless given with --plan-file FILE
+planFile = 'plan.json'
+
+# Should syncs read the users sheets a page of rows at a time, writing each pages changes before reading the next, or run with --stream
+# Keeps memory flat however large the sheets are, for a sheets read and write per page
+streamSync = False
+streamPageRows = 500
+
+# Should rows be skipped when their cells and series/movie data are unchanged since the last run, --full or -f processes every row
+incrementalSync = True
+
+# Should series/movies on no sheet be queued to remove, asking before each, or run with --remove or -r
+removeMissing = False
+
+# File to write a json summary of each sync to, with the time spent in each phase, the api calls made and quota waits, '' to disable
+metricsFile = 'metrics.json'
+# File to write prometheus metrics to after each sync, such as for node exporters textfile collector, '' to disable
+metricsTextFile = ''
+# Port to serve prometheus metrics on at /metrics in daemon mode, 0 to disable, or set with --metrics PORT
+metricsPort = 0
+# Warn on discord when a sync takes longer than this fraction of the interval between syncs
+metricsWarnFraction = 0.75
+
+
+#################################
+############ METRICS ############
+#################################
+
+# Upper bounds in seconds of the api call latency histogram buckets
+latencyBuckets = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+metricsLock = threading.Lock()
+# Api call counts, errors and latencies by service and call, since starting and since the last sync summary
+callMetrics, runCallMetrics = {}, {}
+# Seconds spent in each phase since the last sync summary, summed over workers
+phaseTimes = {}
+# The last sync summary
+lastRun = {}
+
+
+def RecordCall(service, call, seconds, failed):
+    """Count an api call and add its latency to the histogram"""
+    with metricsLock:
+        for metrics in (callMetrics, runCallMetrics):
+            stats = metrics.setdefault((service, call), {
+                'count': 0, 'errors': 0, 'seconds': 0, 'buckets': [0] * len(latencyBuckets)})
+            stats['count'] += 1
+            stats['errors'] += failed and 1 or 0
+            stats['seconds'] += seconds
+            for index, bound in enumerate(latencyBuckets):
+                if seconds <= bound:
+                    stats['buckets'][index] += 1
+
+
+def TimeCall(service, call, func, *args, **kwargs):
+    """Calls an api function, recording how long it took and if it raised an error"""
+    start = time.time()
+    failed = True
+    try:
+        result = func(*args, **kwargs)
+        failed = False
+        return result
+    finally:
+        RecordCall(service, call, time.time() - start, failed)
+
+
+def AddPhaseTime(phase, start):
+    """Add the time since start to a phase, e.g. AddPhaseTime('read', start)"""
+    with metricsLock:
+        phaseTimes[phase] = phaseTimes.get(phase, 0) + time.time() - start
+
+
+class MeteredApi:
+    """Wraps a pyarr api so every method call to it is recorded under the instances name
+    Other attributes, such as the callable auth, are passed through as they are
+    """
+
+    def __init__(self, api, service):
+        self.api = api
+        self.service = service
+
+    def __getattr__(self, name):
+        value = getattr(self.api, name)
+        if not inspect.ismethod(value):
+            return value
+        return lambda *args, **kwargs: TimeCall(self.service, name, value, *args, **kwargs)
+
+
+def MetricsSummary(runSeconds, interval):
+    """Get the summary of the sync, with the phases and api calls since the last summary"""
+    with metricsLock:
+        return {
+            'time': round(time.time()),
+            'seconds': round(runSeconds, 3),
+            'interval': interval,
+            'phases': {phase: round(seconds, 3) for phase, seconds in phaseTimes.items()},
+            'quotaWaits': {bucket: round(waited, 3) for bucket, waited in quotaWaits.items()},
+            'calls': [{'service': service, 'call': call, 'count': stats['count'], 'errors': stats['errors'],
+                       'seconds': round(stats['seconds'], 3)} for (service, call), stats in sorted(runCallMetrics.items())]
+        }
+
+
+def PrometheusLabels(labels):
+    """Format labels for a prometheus sample, e.g. {'phase': 'read'} -> {phase="read"}"""
+    if len(labels) == 0:
+        return ''
+    return '{' + ','.join(key + '=' + json.dumps(str(value)) for key, value in labels.items()) + '}'
+
+
+def PrometheusMetrics():
+    """Get the api calls since starting and the last syncs summary in the prometheus text format"""
+    families = []
+    with metricsLock:
+        calls = sorted(callMetrics.items())
+        families.append(('sheetarr_api_calls_total', 'counter', 'Api calls made since starting',
+                         [('', {'service': service, 'call': call}, stats['count']) for (service, call), stats in calls]))
+        families.append(('sheetarr_api_errors_total', 'counter', 'Api calls that raised an error since starting',
+                         [('', {'service': service, 'call': call}, stats['errors']) for (service, call), stats in calls]))
+        histogram = []
+        for (service, call), stats in calls:
+            labels = {'service': service, 'call': call}
+            for bound, count in zip(latencyBuckets + ['+Inf'], stats['buckets'] + [stats['count']]):
+                histogram.append(('_bucket', dict(labels, le=bound), count))
+            histogram += [('_sum', labels, round(stats['seconds'], 6)), ('_count', labels, stats['count'])]
+        families.append(('sheetarr_api_call_seconds', 'histogram', 'Api call latency', histogram))
+        families.append(('sheetarr_phase_seconds', 'gauge', 'Seconds spent in each phase of the last sync, summed over workers',
+                         [('', {'phase': phase}, seconds) for phase, seconds in sorted(lstd(lastRun, 'phases', {}).items())]))
+        families.append(('sheetarr_quota_wait_seconds', 'gauge', 'Seconds waited on the sheets quota in the last sync',
+                         [('', {'bucket': bucket}, waited) for bucket, waited in sorted(lstd(lastRun, 'quotaWaits', {}).items())]))
+        families.append(('sheetarr_sync_seconds', 'gauge', 'Seconds the last sync took',
+                         [('', {}, lstd(lastRun, 'seconds', 0))]))
+        families.append(('sheetarr_sync_interval_seconds', 'gauge', 'Seconds between syncs',
+                         [('', {}, lstd(lastRun, 'interval', 0))]))
+        families.append(('sheetarr_last_sync_timestamp_seconds', 'gauge', 'Unix time the last sync finished',
+                         [('', {}, lstd(lastRun, 'time', 0))]))
+
+    lines = []
+    for name, kind, description, samples in families:
+        lines += ['# HELP ' + name + ' ' + description, '# TYPE ' + name + ' ' + kind]
+        for suffix, labels, value in samples:
+            lines.append(name + suffix + PrometheusLabels(labels) + ' ' + str(value))
+    return '\n'.join(lines) + '\n'
+
+
+def WriteMetrics(runSeconds, interval):
+    """Write the syncs summary to the metrics files and start the next summary, warning if the sync is close to the interval"""
+    summary = MetricsSummary(runSeconds, interval)
+    with metricsLock:
+        lastRun.clear()
+        lastRun.update(summary)
+        runCallMetrics.clear()
+        phaseTimes.clear()
+
+    if metricsFile:
+        with open(metricsFile, 'w') as json_file:
+            json.dump(summary, json_file, indent=2)
+    if metricsTextFile:
+        # Replace the file at once so the collector never reads it half written
+        with open(metricsTextFile + '.tmp', 'w') as text_file:
+            text_file.write(PrometheusMetrics())
+        os.replace(metricsTextFile + '.tmp', metricsTextFile)
+
+    if runSeconds > interval * metricsWarnFraction:
+        PostDiscord(Fore.RED, 'Sync is close to the interval', 'Took ' + str(round(runSeconds)) +
+                    's of ' + str(round(interval)) + 's')
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    """Serves the prometheus metrics at /metrics"""
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.end_headers()
+            return
+        body = PrometheusMetrics().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
 
 #################################
 ######### AUTHORISATION #########
 #################################
 
-# Read from credentials file
-credentials = json.loads(open('credentials.json').read())
+# Read from credentials file with LoadConfig, nothing is read or connected to until then
+# "sheet" can be a list of {"keyfile", "sheetname"} to sync several spreadsheets
+# "sonarr" and "radarr" can be lists of instances, each with a unique "name" and optionally
+# "resolutions", the resolutions that are added to that instance, e.g. ["2160p"] for a 4k radarr
+credentials = {}
 
-# Authorise google sheets
+# Google sheets clients by keyfile, and the spreadsheets opened with them
 scope = ['https://spreadsheets.google.com/feeds',
          'https://www.googleapis.com/auth/drive']
-creds = ServiceAccountCredentials.from_json_keyfile_name(
-    credentials['sheet']['keyfile'], scope)
-client = gspread.authorize(creds)
-gspreadsheet = client.open(credentials['sheet']['sheetname'])
-
-# Setup pyarr api with auth
-sonarrapi = pyarr.SonarrAPI(
-    credentials['sonarr']['url'], credentials['sonarr']['api'])
-sonarrapi.auth = sonarrapi.basic_auth(
-    username = credentials['sonarr']['authuser'], password = credentials['sonarr']['authpass'])
+clients = {}
+spreadsheets = []
+# Held while loading the config or authorising
+configLock = threading.Lock()
+
+
+def ConfigList(config):
+    """Get a credentials entry as a list, as it can be a single entry or a list"""
+    return isinstance(config, list) and config or [config]
+
+
+def LoadConfig(configFile='credentials.json'):
+    """Read the credentials, set up the sonarr/radarr instances and sessions, and open the cache, once"""
+    global arrSession, discordSession
+    with configLock:
+        if credentials:
+            return
+        import requests
+        with open(configFile) as json_file:
+            config = json.load(json_file)
+        OpenCache()
+        arrSession = PoolSession(requests.Session())
+        discordSession = PoolSession(requests.Session())
+        threading.Thread(target=DiscordWorker, daemon=True).start()
+        sonarrInstances[:] = [SetupInstance(instanceConfig, 'sonarr', config)
+                              for instanceConfig in ConfigList(config['sonarr'])]
+        radarrInstances[:] = [SetupInstance(instanceConfig, 'radarr', config)
+                              for instanceConfig in ConfigList(config['radarr'])]
+        credentials.update(config)
+
+
+def PoolSession(session):
+    """Mount keep-alive connection pools on a requests session, with httpTimeout for requests not giving their own timeout"""
+    from requests.adapters import HTTPAdapter
+
+    class TimeoutAdapter(HTTPAdapter):
+        def send(self, request, **kwargs):
+            if kwargs.get('timeout') is None:
+                kwargs['timeout'] = httpTimeout
+            return super().send(request, **kwargs)
+
+    adapter = TimeoutAdapter(pool_connections=httpPoolSize, pool_maxsize=httpPoolSize)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def CacheToken(keyfile, creds, session):
+    """Use the stored google access token for a keyfile until it expires, then get a new one and store it"""
+    from google.auth.transport.requests import Request
+    tokens = QueryCache('SELECT token, expiry FROM tokens WHERE keyfile = ?', keyfile)
+    if len(tokens) > 0:
+        # Google auth expects expiry times in utc without a timezone
+        creds.token = tokens[0][0]
+        creds.expiry = datetime.datetime.utcfromtimestamp(tokens[0][1])
+    if not creds.valid:
+        TimeCall('sheets', 'token', creds.refresh, Request(session))
+        QueryCache('INSERT OR REPLACE INTO tokens VALUES (?, ?, ?)', keyfile, creds.token,
+                   creds.expiry.replace(tzinfo=datetime.timezone.utc).timestamp())
+        SaveCache()
 
-radarrapi = pyarr.RadarrAPI(
-    credentials['radarr']['url'], credentials['radarr']['api'])
-radarrapi.auth = radarrapi.basic_auth(
-    credentials['sonarr']['authuser'], credentials['sonarr']['authpass'])
 
-# Discord
-discordWebhook = credentials['discord']
+def Authorise():
+    """Authorise google sheets with one client per keyfile and open the spreadsheets, once, returns the spreadsheets"""
+    with configLock:
+        if spreadsheets:
+            return spreadsheets
+        import gspread
+        from google.oauth2.service_account import Credentials
+        start = time.time()
+        for sheetConfig in ConfigList(credentials['sheet']):
+            if sheetConfig['keyfile'] not in clients:
+                creds = Credentials.from_service_account_file(
+                    sheetConfig['keyfile'], scopes=scope)
+                client = gspread.authorize(creds)
+                # gspread 6 moved the session from the client to its http client
+                session = getattr(client, 'http_client', client).session
+                PoolSession(session)
+                CacheToken(sheetConfig['keyfile'], creds, session)
+                clients[sheetConfig['keyfile']] = client
+            spreadsheets.append(TimeCall(
+                'sheets', 'open', clients[sheetConfig['keyfile']].open, sheetConfig['sheetname']))
+        AddPhaseTime('auth', start)
+        return spreadsheets
+
+
+def SetupInstance(config, site, credentials):
+    """Setup pyarr api with auth for a sonarr/radarr instance, along with its routing and library data"""
+    import pyarr
+    isSeries = site == 'sonarr'
+    api = (isSeries and pyarr.SonarrAPI or pyarr.RadarrAPI)(
+        config['url'], config['api'])
+    # Instances without their own login use the first sonarr login
+    sonarrConfig = ConfigList(credentials['sonarr'])[0]
+    api.auth = api.basic_auth(
+        lstd(config, 'authuser', sonarrConfig['authuser']), lstd(config, 'authpass', sonarrConfig['authpass']))
+    # Share the pooled sonarr/radarr session rather than pyarr opening its own
+    api.session = arrSession
+    return {
+        'name': lstd(config, 'name', site),
+        'isSeries': isSeries,
+        'config': config,
+        'api': MeteredApi(api, lstd(config, 'name', site)),
+        'resolutions': lstd(config, 'resolutions', []),
+        'link': lstd(config, 'link', isSeries and sonarrLink or radarrLink),
+        # The sites data, the same indexed by title for constant time matching, and by title words for close matches
+        'list': [],
+        'index': {},
+        'words': {},
+        # Counted up each time the indexes are rebuilt, so results found against them can tell when they are stale
+        'generation': 0
+    }
 
 
 #################################
@@ -88,14 +430,79 @@ def n2a(n, b=string.ascii_uppercase):
     return n2a(d-1, b)+b[m] if d else b[m]
 
 
+def a2n(cell, b=string.ascii_uppercase):
+    """Convert a cell to zero based row and column indexes, e.g. A1 -> 0, 0, AA5 -> 4, 26, ranges use their first cell"""
+    cell = cell.split(':')[0]
+    letters = cell.rstrip(string.digits)
+    column = 0
+    for letter in letters:
+        column = column * len(b) + b.index(letter) + 1
+    return int(cell[len(letters):]) - 1, column - 1
+
+
+def GetArgument(names, default):
+    """Get the value given after any of the named run arguments, e.g. --interval 300"""
+    for index, argument in enumerate(sys.argv[:-1]):
+        if argument in names:
+            return sys.argv[index + 1]
+    return default
+
+
 def lstd(list, key, default=''):
     """Get list data if exists or return default"""
     return list[key] if key in list else default
 
 
-def TitleMatch(name, title, year):
-    """Check if title matches name, with or without the release year"""
-    return title.lower() == name.lower() or (title + ' ' + str(year)).lower() == name.lower()
+def NormaliseTitle(name):
+    """Normalise a title for lookups, e.g. 'The Office 2005' -> 'the office 2005'"""
+    return str(name).lower()
+
+
+def TitleKeys(item, alternates=True):
+    """Get the normalised keys a series/movie can be matched by
+    The title and title with year, optionally alternate titles, and the tvdb/tmdb id as 'tvdb:123' or 'tmdb:123'
+    """
+    keys = [item['title'], item['title'] + ' ' + str(item['year'])]
+    if alternates:
+        for alternate in lstd(item, 'alternateTitles', []):
+            keys.append(alternate['title'])
+            keys.append(alternate['title'] + ' ' + str(item['year']))
+    if lstd(item, 'tvdbId', 0):
+        keys.append('tvdb:' + str(item['tvdbId']))
+    if lstd(item, 'tmdbId', 0):
+        keys.append('tmdb:' + str(item['tmdbId']))
+    return [NormaliseTitle(key) for key in keys]
+
+
+def BuildTitleIndex(items):
+    """Build a dictionary of normalised title keys to series/movie data
+    Main titles take priority over alternate titles shared with another item
+    """
+    index = {}
+    for item in items:
+        for key in TitleKeys(item, alternates=False):
+            index.setdefault(key, item)
+    for item in items:
+        for key in TitleKeys(item):
+            index.setdefault(key, item)
+    return index
+
+
+def TitleWords(title):
+    """Get the lowercase words of a title without punctuation, e.g. "Grey's Anatomy" -> ['grey', 's', 'anatomy']"""
+    return re.findall(r'\w+', str(title).lower())
+
+
+def BuildWordIndex(items):
+    """Build a dictionary of the words in series/movie titles and alternate titles to the series/movies using them"""
+    index = {}
+    for item in items:
+        words = set(TitleWords(item['title']))
+        for alternate in lstd(item, 'alternateTitles', []):
+            words.update(TitleWords(alternate['title']))
+        for word in words:
+            index.setdefault(word, []).append(item)
+    return index
 
 
 def sizeof_fmt(num, suffix="B"):
@@ -116,100 +523,235 @@ def fuzzyMatchList(listA, listB, fuzzyness=0.05):
     return True
 
 
-# Load cache
-cache = {'discord': [], 'quota': []}
+# Cache database, opened by LoadConfig, the write ahead log keeps it intact if a run is interrupted
+# Each query commits straight away so runs at the same time only hold the lock while writing, waiting up to cacheTimeout seconds for it
+cacheDb = None
+cacheTimeout = 60
+cacheLock = threading.RLock()
+
+
+def QueryCache(query, *args):
+    """Runs a query on the cache database, returning all the result rows"""
+    with cacheLock:
+        return cacheDb.execute(query, args).fetchall()
 
 
 def SaveCache():
-    """Saves the cache to a file"""
-    with open('cache.json', 'w') as json_file:
-        json.dump(cache, json_file)
+    """Commits any cache changes still in a transaction to the database"""
+    with cacheLock:
+        cacheDb.commit()
+
+
+def PruneCache():
+    """Remove old entries from discord and lookups cache"""
+    QueryCache('DELETE FROM discord WHERE time < ?',
+               time.time() - discordHistoryTime)
+    QueryCache('DELETE FROM lookups WHERE time < ?',
+               time.time() - lookupCacheTime)
+    SaveCache()
+
+
+def MarkDiscordSent(message):
+    """Records a discord message as sent, returns False if it was already sent"""
+    with cacheLock:
+        return cacheDb.execute('INSERT OR IGNORE INTO discord VALUES (?, ?)', (message, time.time())).rowcount == 1
 
 
-if os.path.isfile('cache.json'):
-    with open('cache.json') as json_file:
-        cache = json.load(json_file)
+def GetRowCache(rowKey):
+    """Get the fingerprint, fileSize and hasFile stored for a row, or None"""
+    rows = QueryCache(
+        'SELECT fingerprint, fileSize, hasFile FROM rows WHERE key = ?', rowKey)
+    return rows and dict(zip(['fingerprint', 'fileSize', 'hasFile'], rows[0])) or None
 
-    # Remove old entries from quota cache
-    quotaList = [key for key in cache['quota'] if time.time() - key < 60]
-    if cache['quota'] != quotaList:
-        cache['quota'] = quotaList
+
+def SetRowCache(rowKey, fingerprint, fileSize, hasFile):
+    """Store the fingerprint, fileSize and hasFile for a row, or remove it if fingerprint is None"""
+    if fingerprint is None:
+        QueryCache('DELETE FROM rows WHERE key = ?', rowKey)
+    else:
+        QueryCache('INSERT OR REPLACE INTO rows VALUES (?, ?, ?, ?)',
+                   rowKey, fingerprint, fileSize, hasFile)
+
+
+def GetMeta(key, default=0):
+    """Get a stored number, such as the time of the last library refresh"""
+    rows = QueryCache('SELECT value FROM meta WHERE key = ?', key)
+    return rows and rows[0][0] or default
+
+
+def SetMeta(key, value):
+    """Store a number, such as the time of the last library refresh"""
+    QueryCache('INSERT OR REPLACE INTO meta VALUES (?, ?)', key, value)
+
+
+def OpenCache():
+    """Open the cache database, moving over the old json cache if there is one"""
+    global cacheDb
+    cacheDb = sqlite3.connect('cache.db', timeout=cacheTimeout,
+                              isolation_level=None, check_same_thread=False)
+    cacheDb.execute('PRAGMA journal_mode=WAL')
+    # With the write ahead log the cache stays intact without syncing to disk on every commit
+    cacheDb.execute('PRAGMA synchronous=NORMAL')
+    cacheDb.executescript('''
+        CREATE TABLE IF NOT EXISTS discord (message TEXT PRIMARY KEY, time REAL);
+        CREATE INDEX IF NOT EXISTS discord_time ON discord (time);
+        CREATE TABLE IF NOT EXISTS ratelimit (name TEXT PRIMARY KEY, tokens REAL, time REAL);
+        CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, fingerprint TEXT, fileSize INTEGER, hasFile REAL);
+        CREATE TABLE IF NOT EXISTS library (site TEXT, id INTEGER, data TEXT, PRIMARY KEY (site, id));
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value REAL);
+        CREATE TABLE IF NOT EXISTS lookups (key TEXT PRIMARY KEY, time REAL, results TEXT);
+        CREATE INDEX IF NOT EXISTS lookups_time ON lookups (time);
+        CREATE TABLE IF NOT EXISTS aliases (key TEXT PRIMARY KEY, target TEXT, time REAL);
+        CREATE TABLE IF NOT EXISTS suggestions (key TEXT PRIMARY KEY, name TEXT, candidates TEXT);
+        CREATE TABLE IF NOT EXISTS tokens (keyfile TEXT PRIMARY KEY, token TEXT, expiry REAL);
+    ''')
+    aliases.update(QueryCache('SELECT key, target FROM aliases'))
+
+    # Remove the old quota table, replaced by ratelimit, checked with a read so startup doesn't take the write lock
+    if QueryCache("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'quota'"):
+        QueryCache('DROP TABLE quota')
+
+    # Move over the old json cache
+    if os.path.isfile('cache.json'):
+        with open('cache.json') as json_file:
+            oldCache = json.load(json_file)
+        for rowKey, row in lstd(oldCache, 'rows', {}).items():
+            SetRowCache(rowKey, row['fingerprint'], row['fileSize'], row['hasFile'])
+        for key, lookup in lstd(oldCache, 'lookups', {}).items():
+            QueryCache('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)',
+                       key, lookup['time'], json.dumps(lookup['results']))
         SaveCache()
+        os.replace('cache.json', 'cache.json.old')
 
+    PruneCache()
 
-def PostDiscord(colour, message, footer):
-    """Posts a discord message"""
-    # Send message once per day max
-    newcolor = colour == Fore.YELLOW and 14865460 \
+
+# Discord embeds waiting to be sent, and the session they are sent with, started by LoadConfig
+discordQueue = queue.Queue()
+discordSession = None
+
+
+def DiscordColour(colour):
+    """Get the discord embed colour for a terminal colour"""
+    return colour == Fore.YELLOW and 14865460 \
         or colour == Fore.RED and 16393509 \
         or colour == Fore.MAGENTA and 14034426 \
         or 16777215
-    data = {
-        "content": None,
-        "embeds": [
-            {
-                "title": message,
-                "color": newcolor,
-                "footer": {
-                    "text": footer
-                }
-            }
-        ]
-    }
-    debugmsg = datetime.date.today().strftime(
-        '%Y-%m-%d') + ' - ' + message + ' ' + footer
+
+
+def EmbedLength(embed):
+    """Get the number of characters in an embed that count towards discords limit of 6000 per message"""
+    return len(embed['title']) + len(embed['footer']['text']) + sum(
+        len(field['name']) + len(field['value']) for field in lstd(embed, 'fields', []))
+
+
+def SendDiscord(embeds):
+    """Sends embeds in one discord message, waiting and retrying if rate limited, up to discordRetries times"""
+    for attempt in range(discordRetries + 1):
+        response = TimeCall('discord', 'webhook', discordSession.post, credentials['discord'], json={
+            "content": None, "embeds": embeds})
+        if response.status_code != 429:
+            break
+        if attempt == discordRetries:
+            raise RuntimeError('Rate limited ' + str(attempt + 1) + ' times, dropping ' + str(len(embeds)) + ' embeds')
+        # Rate limited, retry after the time given in seconds
+        time.sleep(float(lstd(response.json(), 'retry_after', 1)))
+
+    # Wait for the rate limit to reset if this was the last message allowed
+    if response.headers.get('X-RateLimit-Remaining') == '0':
+        time.sleep(float(response.headers.get('X-RateLimit-Reset-After', 1)))
+
+
+def DiscordWorker():
+    """Sends queued discord embeds in batches, off the main thread
+    Every embed taken is marked done even if sending fails, so waiting for the queue never hangs
+    """
+    while True:
+        embeds = [discordQueue.get()]
+        try:
+            length = EmbedLength(embeds[0])
+            # Gather any more embeds that arrive soon after, within discords limits
+            while len(embeds) < 10:
+                try:
+                    embed = discordQueue.get(timeout=discordBatchDelay)
+                except queue.Empty:
+                    break
+                embeds.append(embed)
+                if length + EmbedLength(embed) > 6000:
+                    embeds.pop()
+                    discordQueue.task_done()
+                    discordQueue.put(embed)
+                    break
+                length += EmbedLength(embed)
+            SendDiscord(embeds)
+        except Exception as error:
+            print(Fore.RED + 'Failed to send discord message: ' +
+                  repr(error) + Style.RESET_ALL)
+        finally:
+            for embed in embeds:
+                discordQueue.task_done()
+
+
+def WaitDiscord():
+    """Wait up to discordExitWait seconds for the queued discord messages to send, giving up on any left"""
+    waiter = threading.Thread(target=discordQueue.join, daemon=True)
+    waiter.start()
+    waiter.join(discordExitWait)
+    if waiter.is_alive():
+        print(Fore.RED + 'Gave up sending ' + str(discordQueue.unfinished_tasks) +
+              ' discord messages' + Style.RESET_ALL)
+
+
+def QueueDiscord(verbosity, colour, debugmsg, embed):
+    """Prints the message and queues the embed to send to discord, once per day max"""
     print(colour + debugmsg + Style.RESET_ALL)
-    if debugmsg not in cache['discord']:
-        requests.post(discordWebhook, headers={
-                      "Content-Type": "application/json"}, data=json.dumps(data))
-        cache['discord'].append(debugmsg)
+    if discordVerbosity >= verbosity and MarkDiscordSent(debugmsg):
         SaveCache()
+        embed['color'] = DiscordColour(colour)
+        embed['title'] = embed['title'][:256]
+        embed['footer'] = {'text': embed['footer']['text'][:2048]}
+        discordQueue.put(embed)
+
+
+def PostDiscord(colour, message, footer):
+    """Posts a discord message"""
+    debugmsg = datetime.date.today().strftime(
+        '%Y-%m-%d') + ' - ' + message + ' ' + footer
+    QueueDiscord(1, colour, debugmsg, {
+        "title": message,
+        "footer": {
+            "text": footer
+        }
+    })
 
 
 def PostDiscordCell(colour, sheet, cell, type, footer):
     """Posts a discord message with cell formatting"""
-    # Send message once per day max
-    newcolor = colour == Fore.YELLOW and 14865460 \
-        or colour == Fore.RED and 16393509 \
-        or colour == Fore.MAGENTA and 14034426 \
-        or 16777215
-    data = {
-        "content": None,
-        "embeds": [
-            {
-                "title": "",
-                "color": newcolor,
-                "fields": [
-                    {
-                        "name": "Sheet",
-                        "value": sheet,
-                        "inline": True
-                    },
-                    {
-                        "name": "Cell",
-                        "value": cell,
-                        "inline": True
-                    },
-                    {
-                        "name": "Type",
-                        "value": type,
-                        "inline": True
-                    }
-                ],
-                "footer": {
-                    "text": footer
-                }
-            }
-        ]
-    }
     debugmsg = datetime.date.today().strftime('%Y-%m-%d') + ' - ' + \
         sheet + ' ' + cell + ' ' + type + ' ' + footer
-    print(colour + debugmsg + Style.RESET_ALL)
-    if debugmsg not in cache['discord']:
-        requests.post(discordWebhook, headers={
-            "Content-Type": "application/json"}, data=json.dumps(data))
-        cache['discord'].append(debugmsg)
-        SaveCache()
+    QueueDiscord(2, colour, debugmsg, {
+        "title": "",
+        "fields": [
+            {
+                "name": "Sheet",
+                "value": sheet,
+                "inline": True
+            },
+            {
+                "name": "Cell",
+                "value": cell,
+                "inline": True
+            },
+            {
+                "name": "Type",
+                "value": type,
+                "inline": True
+            }
+        ],
+        "footer": {
+            "text": footer
+        }
+    })
 
 
 # Profile id to resolution
@@ -225,137 +767,937 @@ qualityResolutions = {'SD': 480, '720p': 720,
 ######## GRAB SITES DATA ########
 #################################
 
-sonarrList = sonarrapi.get_series()
-radarrList = radarrapi.get_movie()
+# Set up by LoadConfig
+sonarrInstances = []
+radarrInstances = []
+# Held while changing an instances library data
+libraryLock = threading.Lock()
+
+
+def Instances(isSeries):
+    """Get the sonarr or radarr instances"""
+    return isSeries and sonarrInstances or radarrInstances
+
+
+def GetInstance(isSeries, name):
+    """Get a sonarr/radarr instance by name, or the first instance if not found"""
+    instances = Instances(isSeries)
+    return ([instance for instance in instances if instance['name'].lower() == str(name).lower()] or instances)[0]
+
+
+def RouteInstance(isSeries, resolution):
+    """Get the sonarr/radarr instance a resolution is added to
+    The first instance listing the resolution, else the first instance without resolutions listed, else the first instance
+    """
+    instances = Instances(isSeries)
+    return ([instance for instance in instances if resolution in instance['resolutions']] or
+            [instance for instance in instances if len(instance['resolutions']) == 0] or instances)[0]
+
+
+def FindMedia(name, resolution, isSeries):
+    """Find a series/movie on sonarr/radarr by title, returns the instance and item, or None, None if not found
+    Resolutions routed to an instance are only found on that instance, others are found on any with the routed instance first
+    """
+    key = NormaliseTitle(name)
+    alias = aliases.get(LookupKey(name, isSeries))
+    routed = RouteInstance(isSeries, resolution)
+    candidates = [routed]
+    if resolution not in routed['resolutions']:
+        candidates += [instance for instance in Instances(isSeries) if instance is not routed]
+    for instance in candidates:
+        item = instance['index'].get(key)
+        if item is None and alias is not None:
+            item = instance['index'].get(alias)
+        if item is not None:
+            return instance, item
+    return None, None
+
+
+# Pooled session for requests to sonarr/radarr, shared with pyarr, started by LoadConfig
+arrSession = None
+
+
+def CallArr(instance, method, path, params=None, body=None):
+    """Call the sonarr/radarr api with the same auth as pyarr, returns the response data, or None if not found or empty"""
+    # Ids are left out of the metrics name, e.g. series/5 -> series
+    call = '/'.join(part for part in path.split('/') if not part.isdigit())
+    response = TimeCall(instance['name'], call, arrSession.request, method, instance['config']['url'].rstrip('/') + '/api/v3/' + path,
+                        params=params, json=body, headers={'X-Api-Key': instance['config']['api']}, auth=instance['api'].auth)
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    if len(response.content) == 0:
+        return None
+    return response.json()
+
+
+def GetArr(instance, path, params=None):
+    """Get from the sonarr/radarr api with the same auth as pyarr, returns None if not found"""
+    return CallArr(instance, 'GET', path, params)
+
+
+def UpdateLibraryItems(instance, items):
+    """Replace series/movies in the instances data and stored library, from a dictionary of id to item, removing those that are None"""
+    with libraryLock:
+        siteList = [siteItem for siteItem in instance['list']
+                    if siteItem['id'] not in items]
+        for itemId, item in items.items():
+            if item is None:
+                QueryCache('DELETE FROM library WHERE site = ? AND id = ?',
+                           instance['name'], itemId)
+            else:
+                siteList.append(item)
+                QueryCache('INSERT OR REPLACE INTO library VALUES (?, ?, ?)',
+                           instance['name'], itemId, json.dumps(item))
+        instance['list'], instance['index'] = siteList, BuildTitleIndex(siteList)
+        instance['words'] = BuildWordIndex(siteList)
+        instance['generation'] += 1
+
+
+def UpdateLibraryItem(instance, itemId, item):
+    """Replace a series/movie in the instances data and stored library, removing it if item is None"""
+    UpdateLibraryItems(instance, {itemId: item})
+
+
+def RefreshSite(instance):
+    """Refresh the series/movies of a sonarr/radarr instance, downloading everything on a schedule, else only items changed since the last refresh"""
+    site = instance['name']
+    isSeries = instance['isSeries']
+    siteList = instance['list']
+    now = time.time()
+    lastRefresh = GetMeta(site + 'Refresh')
+    if now - GetMeta(site + 'FullRefresh') > libraryFullRefreshTime:
+        if isSeries:
+            siteList = instance['api'].get_series()
+        else:
+            siteList = instance['api'].get_movie()
+        # Replace the stored library in one transaction
+        with cacheLock, cacheDb:
+            cacheDb.execute('BEGIN IMMEDIATE')
+            cacheDb.execute('DELETE FROM library WHERE site = ?', (site,))
+            cacheDb.executemany('INSERT INTO library VALUES (?, ?, ?)', [
+                (site, item['id'], json.dumps(item)) for item in siteList])
+        SetMeta(site + 'FullRefresh', now)
+    else:
+        # Load the stored library if not already loaded
+        if len(siteList) == 0:
+            siteList = [json.loads(row[0]) for row in QueryCache(
+                'SELECT data FROM library WHERE site = ?', site)]
+
+        # Download the items with history since the last refresh, with a minute of overlap
+        since = datetime.datetime.utcfromtimestamp(
+            lastRefresh - 60).strftime('%Y-%m-%dT%H:%M:%SZ')
+        idKey = isSeries and 'seriesId' or 'movieId'
+        changedIds = {record[idKey] for record in GetArr(
+            instance, 'history/since', {'date': since}) if idKey in record}
+        items = {item['id']: item for item in siteList}
+        for itemId in changedIds:
+            item = GetArr(instance, (isSeries and 'series/' or 'movie/') + str(itemId))
+            items.pop(itemId, None)
+            if item is None:
+                QueryCache('DELETE FROM library WHERE site = ? AND id = ?', site, itemId)
+            else:
+                items[itemId] = item
+                QueryCache('INSERT OR REPLACE INTO library VALUES (?, ?, ?)',
+                           site, itemId, json.dumps(item))
+        siteList = list(items.values())
+        if len(changedIds) > 0:
+            print(Fore.YELLOW + 'Updated ' + str(len(changedIds)) + ' items from ' +
+                  site.capitalize() + Style.RESET_ALL)
+
+    SetMeta(site + 'Refresh', now)
+    SaveCache()
+    with libraryLock:
+        instance['list'], instance['index'] = siteList, BuildTitleIndex(siteList)
+        instance['words'] = BuildWordIndex(siteList)
+        instance['generation'] += 1
+
+
+def RefreshLibrary():
+    """Refresh the series and movies of every sonarr/radarr instance at once and index them by title"""
+    start = time.time()
+    instances = sonarrInstances + radarrInstances
+    with ThreadPoolExecutor(len(instances)) as pool:
+        for future in [pool.submit(RefreshSite, instance) for instance in instances]:
+            future.result()
+    AddPhaseTime('library', start)
+
 
 # Search against sonarr/radarr
 
+# Number of search results kept, and the fields kept from each for matching, with the library id if already on the site
+lookupResultCount = 2
+lookupFields = ['id', 'title', 'year', 'tvdbId', 'tmdbId']
+
+
+def LookupKey(name, isseries):
+    """Get the lookups cache key for a search, e.g. 'series:the office'"""
+    return (isseries and 'series:' or 'movie:') + NormaliseTitle(name)
+
+
+def LookupSite(name, isseries):
+    """Search sonarr/radarr for the series/movie, returning the first few results with the fields used for matching"""
+    api = Instances(isseries)[0]['api']
+    if isseries:
+        response = api.lookup_series(name)
+    else:
+        response = api.lookup_movie(name)
+
+    results = []
+    for result in response[:lookupResultCount]:
+        fields = {key: result[key] for key in lookupFields if key in result}
+        fields['alternateTitles'] = [{'title': alternate['title']}
+                                     for alternate in lstd(result, 'alternateTitles', [])]
+        results.append(fields)
+    return results
+
+
+def GetCachedLookup(name, isseries):
+    """Get the cached search results for the series/movie, or None if not searched recently"""
+    lookups = QueryCache('SELECT results FROM lookups WHERE key = ? AND time > ?',
+                         LookupKey(name, isseries), time.time() - lookupCacheTime)
+    if len(lookups) == 0:
+        return None
+    return json.loads(lookups[0][0])
+
+
+def CacheLookup(name, isseries, results):
+    """Store search results for the series/movie, empty results are stored so failed searches aren't repeated"""
+    QueryCache('INSERT OR REPLACE INTO lookups VALUES (?, ?, ?)',
+               LookupKey(name, isseries), time.time(), json.dumps(results))
+
+
+def LookupMedia(name, isseries):
+    """Search sonarr/radarr for the series/movie, using the cached results if recent"""
+    results = GetCachedLookup(name, isseries)
+    if results is None:
+        results = LookupSite(name, isseries)
+        CacheLookup(name, isseries, results)
+    return results
+
+
+def PrefetchLookups(searches):
+    """Run searches concurrently for a list of name and is series pairs, caching the results"""
+    if len(searches) == 0:
+        return
+    start = time.time()
+    print(Fore.YELLOW + 'Searching for ' + str(len(searches)) +
+          ' titles' + Style.RESET_ALL)
+    with ThreadPoolExecutor(lookupWorkers) as pool:
+        futures = {pool.submit(LookupSite, name, isseries): (
+            name, isseries) for name, isseries in searches}
+        for future in as_completed(futures):
+            name, isseries = futures[future]
+            try:
+                CacheLookup(name, isseries, future.result())
+            except Exception as error:
+                print(Fore.RED + 'Search failed for ' + name +
+                      ': ' + repr(error) + Style.RESET_ALL)
+    SaveCache()
+    AddPhaseTime('lookups', start)
+
+
+
+# Resolve titles that don't match exactly
+
+# Score from 0 to 1 a close match needs to be accepted without asking, and how far ahead of the next best it must be
+fuzzyMatchScore = 0.8
+fuzzyMatchMargin = 0.05
+# Number of series/movies sharing the most words with a title to score against it
+fuzzyCandidateCount = 50
+
+# Titles learned to mean a series/movie, by lookup key to tvdb/tmdb key, e.g. 'series:the ofice' -> 'tvdb:73244'
+aliases = {}
+# Titles with no close match, by lookup key to the index generations they were checked against, so they aren't checked again until the sites change
+unresolvedTitles = {}
+
+
+def ItemKey(item, isSeries):
+    """Get the tvdb/tmdb key of a series/movie, e.g. 'tvdb:73244', or None if it has no id"""
+    idKey = isSeries and 'tvdbId' or 'tmdbId'
+    return lstd(item, idKey, 0) and (isSeries and 'tvdb:' or 'tmdb:') + str(item[idKey]) or None
+
+
+def SaveAlias(name, isSeries, target):
+    """Remember a title as meaning the series/movie with the tvdb/tmdb key, so it is found without searching next time"""
+    key = LookupKey(name, isSeries)
+    if target is not None and aliases.get(key) != target:
+        aliases[key] = target
+        QueryCache('INSERT OR REPLACE INTO aliases VALUES (?, ?, ?)',
+                   key, target, time.time())
+
+
+def SplitYear(name):
+    """Split a year off the end of a title, e.g. 'The Office (2005)' -> 'The Office', 2005, 'Lost' -> 'Lost', None"""
+    match = re.fullmatch(r'(.*?\w.*?)[\s(]+((?:19|20)\d\d)\)?', str(name).strip())
+    if match is None:
+        return name, None
+    return match.group(1), int(match.group(2))
+
+
+def EditDistance(a, b, limit=None):
+    """Get the number of characters to insert, delete, change or swap with the next to turn a into b
+    Stops early once it is over the limit if given, returning limit + 1
+    """
+    if limit is not None and abs(len(a) - len(b)) > limit:
+        return limit + 1
+    beforePrevious, previous = None, list(range(len(b) + 1))
+    for i, charA in enumerate(a, 1):
+        current = [i]
+        for j, charB in enumerate(b, 1):
+            distance = min(previous[j] + 1, current[j - 1] + 1,
+                           previous[j - 1] + (charA != charB))
+            if i > 1 and j > 1 and charA == b[j - 2] and a[i - 2] == charB:
+                distance = min(distance, beforePrevious[j - 2] + 1)
+            current.append(distance)
+        if limit is not None and min(current) > limit:
+            return limit + 1
+        beforePrevious, previous = previous, current
+    return previous[-1]
+
+
+def TitleScore(name, candidate, minimum=0):
+    """Score how closely a name matches a series/movie from 0 to 1
+    By the edit distance and shared words of its closest title or alternate title, raised if the year given matches and lowered if not
+    Titles that can't score the minimum are scored 0 without working out their full edit distance
+    """
+    title, year = SplitYear(name)
+    words = TitleWords(title)
+    text = ' '.join(words)
+    score = 0
+    for candidateTitle in [candidate['title']] + [alternate['title'] for alternate in lstd(candidate, 'alternateTitles', [])]:
+        candidateWords = TitleWords(candidateTitle)
+        candidateText = ' '.join(candidateWords)
+        length = max(len(text), len(candidateText), 1)
+        # The most edits that can still reach the minimum with every word shared and the year matching
+        limit = int((1 - (minimum - 0.2) / 0.85) * length)
+        distance = EditDistance(text, candidateText, limit)
+        if distance > limit:
+            continue
+        similarity = 1 - distance / length
+        overlap = len(set(words) & set(candidateWords)) / \
+            max(len(set(words) | set(candidateWords)), 1)
+        score = max(score, 0.85 * similarity + 0.15 * overlap)
+    if year is not None:
+        score += str(year) == str(lstd(candidate, 'year', '')) and 0.05 or -0.2
+    return min(score, 1)
+
+
+def LibraryCandidates(name, isSeries):
+    """Get the series/movies on the sites sharing the most words with the name, once each by tvdb/tmdb key"""
+    words = set(TitleWords(SplitYear(name)[0]))
+    candidates = {}
+    shared = {}
+    for instance in Instances(isSeries):
+        for word in words:
+            for item in lstd(instance['words'], word, []):
+                key = ItemKey(item, isSeries)
+                if key is not None:
+                    candidates.setdefault(key, item)
+                    shared[key] = shared.get(key, 0) + 1
+    best = sorted(shared, key=shared.get, reverse=True)[:fuzzyCandidateCount]
+    return [candidates[key] for key in best]
+
+
+def RankCandidates(name, candidates, minimum=0):
+    """Get the candidates with their scores for the name, best first"""
+    ranked = [(TitleScore(name, candidate, minimum), candidate) for candidate in candidates]
+    ranked.sort(key=lambda scored: scored[0], reverse=True)
+    return ranked
+
+
+def BestMatch(name, candidates):
+    """Get the candidate the name matches closely enough to accept without asking, or None"""
+    ranked = RankCandidates(name, candidates, fuzzyMatchScore - fuzzyMatchMargin)
+    if len(ranked) == 0 or ranked[0][0] < fuzzyMatchScore:
+        return None
+    # A year given that isn't the best matches year is another series/movie, such as a remake, so is never accepted
+    year = SplitYear(name)[1]
+    if year is not None and str(year) != str(lstd(ranked[0][1], 'year', '')):
+        return None
+    if len(ranked) > 1 and ranked[0][0] - ranked[1][0] < fuzzyMatchMargin:
+        return None
+    return ranked[0][1]
+
+
+def ResolveLibrary(name, isSeries):
+    """Match a name to a series/movie on the sites by close spelling, remembering it as an alias, returns True if matched"""
+    key = LookupKey(name, isSeries)
+    generations = [(instance['name'], instance['generation']) for instance in Instances(isSeries)]
+    if unresolvedTitles.get(key) == generations:
+        return False
+    match = BestMatch(name, LibraryCandidates(name, isSeries))
+    if match is None:
+        unresolvedTitles[key] = generations
+        return False
+    SaveAlias(name, isSeries, ItemKey(match, isSeries))
+    return True
+
+
+def Suggestions(name, isSeries, results):
+    """Get the closest series/movies from the search results and the sites to suggest for a name, as title, year and tvdb/tmdb key"""
+    candidates = {}
+    for candidate in results + LibraryCandidates(name, isSeries):
+        candidates.setdefault(ItemKey(candidate, isSeries) or candidate['title'], candidate)
+    return [{'title': candidate['title'], 'year': lstd(candidate, 'year', ''), 'key': ItemKey(candidate, isSeries)}
+            for score, candidate in RankCandidates(name, list(candidates.values()))[:lookupResultCount]]
+
+
+def SaveSuggestions(rowKey, name, suggestions):
+    """Store the suggestions given for a row, to learn which the user picks"""
+    QueryCache('INSERT OR REPLACE INTO suggestions VALUES (?, ?, ?)',
+               rowKey, name, json.dumps(suggestions))
+
+
+def LearnSuggestion(rowKey, name, isSeries):
+    """If the row was given suggestions and now has one of them, remember its old title as an alias of the picked series/movie"""
+    rows = QueryCache('SELECT name, candidates FROM suggestions WHERE key = ?', rowKey)
+    if len(rows) == 0 or NormaliseTitle(rows[0][0]) == NormaliseTitle(name):
+        return
+    for suggestion in json.loads(rows[0][1]):
+        if NormaliseTitle(name) in TitleKeys(suggestion, alternates=False):
+            SaveAlias(rows[0][0], isSeries, suggestion['key'])
+    QueryCache('DELETE FROM suggestions WHERE key = ?', rowKey)
+
+
+def QueueAdd(name, wantedres, isseries, instance, itemId):
+    """Queue a series/movie to add to sonarr/radarr by tvdb/tmdb id when the changes are applied"""
+    if wantedres in qualityFromProfile:
+        QueueArrChange({
+            'type': 'add',
+            'isSeries': isseries,
+            'instance': instance['name'],
+            'title': name,
+            'id': itemId,
+            'qualityProfileId': qualityFromProfile[wantedres]
+        })
+
 
 def SearchAgainstSite(name, wantedres, isseries):
-    """Returns the series/movie data if found, else adds the series/movie to sonarr/radarr
+    """Returns the series/movie data if found, else queues the series/movie to add to sonarr/radarr
     name, the name of the series/movie to search for
     wantedres, the resolution to search for if adding
     isseries, a boolean for if the search is for a series or a movie
 
-    Returns the status of the search
+    Returns the status of the search, and the instance found on or added to
     'found', item - the series/movie data object if the series/movie was found existing
-    'adding' - the series/movie wasn't found but was matched correctly and was added to sonarr/radarr
-    'failedmatch', matches - the series/movie did not match exactly but potential matches were found
+    'adding' - the series/movie wasn't found but was matched correctly and is queued to add to sonarr/radarr
+    'failedmatch', suggestions - the series/movie did not match closely but potential matches were found, as title, year and key
     'failed' - the series/movie could not be matched
     """
 
-    # Find if item is already on sonarr/radarr
-    found = False
-    for item in isseries and sonarrList or radarrList:
-        if TitleMatch(name, item['title'], item['year']):
-            found = True
-            return 'found', item
+    # Find if item is already on sonarr/radarr, by title, alias or close spelling
+    instance, item = FindMedia(name, wantedres, isseries)
+    if item is None and ResolveLibrary(name, isseries):
+        instance, item = FindMedia(name, wantedres, isseries)
+    if item is not None:
+        return 'found', item, instance
+
+    instance = RouteInstance(isseries, wantedres)
+    # Titles learned to mean a series/movie not on the sites yet are added without searching
+    alias = aliases.get(LookupKey(name, isseries))
+    if alias is not None:
+        QueueAdd(name, wantedres, isseries, instance, int(alias.split(':')[1]))
+        return 'adding', None, instance
 
     # If not found, do a search to find closest match
-    if not found:
-        response = None
-        if isseries:
-            response = sonarrapi.lookup_series(name)
+    response = LookupMedia(name, isseries)
+
+    # Check if matches are found
+    if len(response) > 0:
+        titleyear = response[0]['title'] + ' -' + str(response[0]['year'])
+        match = NormaliseTitle(name) in TitleKeys(response[0]) and response[0] or BestMatch(name, response)
+        if match is not None:
+            SaveAlias(name, isseries, ItemKey(match, isseries))
+            # Already on the searched instance but added since its library was refreshed, fetch it rather than adding again
+            # Resolutions routed to another instance are still added there, as with FindMedia
+            lookupInstance = Instances(isseries)[0]
+            if lstd(match, 'id', 0) and (lookupInstance is instance or wantedres not in instance['resolutions']):
+                item = GetArr(lookupInstance, (isseries and 'series/' or 'movie/') + str(match['id']))
+                if item is not None:
+                    UpdateLibraryItem(lookupInstance, item['id'], item)
+                    return 'found', item, lookupInstance
+            # Search result found and matches, add it to sonarr/radarr when the changes are applied
+            QueueAdd(name, wantedres, isseries, instance, match[isseries and 'tvdbId' or 'tmdbId'])
+            return 'adding', None, instance
         else:
-            response = radarrapi.lookup_movie(name)
-
-        # Check if matches are found
-        if len(response) > 0:
-            titleyear = response[0]['title'] + ' -' + str(response[0]['year'])
-            if TitleMatch(name, response[0]['title'], response[0]['year']):
-                # Search result found and matches
-                if isseries:
-                    # Add result to sonarr
-                    if wantedres in qualityFromProfile:
-                        # Send debug message to discord
-                        PostDiscord(Fore.MAGENTA, 'Adding to Sonarr', name)
-                        # Add to sonarr
-                        wantedQuality = qualityFromProfile[wantedres]
-                        try:
-                            sonarrapi.add_series(tvdb_id=response[0]['tvdbId'], quality_profile_id=wantedQuality, root_dir='/tv', season_folder=True, monitored=True, search_for_missing_episodes=True)
-                        except:
-                            PostDiscord(Fore.RED, 'Failed to add to Sonarr', name)
-                else:
-                    # Add result to radarr
-                    if wantedres in qualityFromProfile:
-                        # Send debug message to discord
-                        PostDiscord(Fore.MAGENTA, 'Adding to Radarr', name)
-                        # Add to radarr
-                        wantedQuality = qualityFromProfile[wantedres]
-                        radarrresp = radarrapi.add_movie(response[0]['tmdbId'], wantedQuality, '/movies', monitored=True, search_for_movie=True, tmdb=True)
-
-                return 'adding', None
-            else:
-                # Search result found but not exact match
-                PostDiscord(Fore.RED, 'FAILED', name + ' ' *
-                            (50 - len(titleyear)) + titleyear)
-
-                # Add first few results to match data
-                matches = []
-                for i in range(0, 2):
-                    if len(response) > i:
-                        matches.append(response[i]['title'])
-                return 'failedmatch', matches
+            # Search result found but not close enough
+            PostDiscord(Fore.RED, 'FAILED', name + ' ' *
+                        (50 - len(titleyear)) + titleyear)
+            return 'failedmatch', Suggestions(name, isseries, response), instance
+    else:
+        # Search result not found
+        PostDiscord(Fore.RED, 'FAILED', name)
+        return 'failed', None, instance
+
+
+# Changes to make to sonarr/radarr when the plan is applied, by type, instance name and id
+# Each is a dictionary of type 'add', 'profile' or 'remove', isSeries, instance, title, id and for adds and profiles qualityProfileId
+# Adds use the tvdb/tmdb id, profiles and removes the sonarr/radarr id
+arrChanges = {}
+changesLock = threading.Lock()
+
+
+def QueueArrChange(change):
+    """Queue a change to sonarr/radarr, replacing any change of the same type to the same series/movie"""
+    with changesLock:
+        arrChanges[(change['type'], change['instance'], change['id'])] = change
+
+
+def AddMedia(change):
+    """Add a queued series/movie to sonarr/radarr without searching for it, returns the added item or None"""
+    instance = GetInstance(change['isSeries'], change['instance'])
+    site = instance['name'].capitalize()
+    PostDiscord(Fore.MAGENTA, 'Adding to ' + site, change['title'])
+    try:
+        if change['isSeries']:
+            added = instance['api'].add_series(tvdb_id=change['id'], quality_profile_id=change['qualityProfileId'], root_dir='/tv',
+                                               season_folder=True, monitored=True, search_for_missing_episodes=False)
         else:
-            # Search result not found
-            PostDiscord(Fore.RED, 'FAILED', name)
-            return 'failed', None
+            added = instance['api'].add_movie(change['id'], change['qualityProfileId'], '/movies',
+                                              monitored=True, search_for_movie=False, tmdb=True)
+        if isinstance(added, dict) and 'id' in added:
+            return added
+    except Exception:
+        PostDiscord(Fore.RED, 'Failed to add to ' + site, change['title'])
+    return None
+
+
+def SearchMedia(instance, itemIds):
+    """Search for newly added series/movies, radarr searches every movie in one command, sonarr can only search one series per command"""
+    if instance['isSeries']:
+        for itemId in itemIds:
+            CallArr(instance, 'POST', 'command', body={'name': 'SeriesSearch', 'seriesId': itemId})
+    else:
+        CallArr(instance, 'POST', 'command', body={'name': 'MoviesSearch', 'movieIds': itemIds})
+
+
+def EditProfiles(instance, qualityProfileId, changes):
+    """Set the quality profile of several series/movies in one bulk edit, returns the changed items that were loaded"""
+    isSeries = instance['isSeries']
+    site = instance['name'].capitalize()
+    itemIds = [change['id'] for change in changes]
+    try:
+        CallArr(instance, 'PUT', isSeries and 'series/editor' or 'movie/editor', body={
+            isSeries and 'seriesIds' or 'movieIds': itemIds, 'qualityProfileId': qualityProfileId})
+    except Exception as error:
+        PostDiscord(Fore.RED, 'Failed to adjust {site} resolutions'.format(site=site), repr(error))
+        return []
+
+    editedIds = set(itemIds)
+    items = {item['id']: item for item in instance['list'] if item['id'] in editedIds}
+    changed = []
+    for change in changes:
+        item = lstd(items, change['id'], None)
+        oldResolution = item and lstd(qualityProfiles, item['qualityProfileId'], 'Any') or 'unknown'
+        PostDiscord(Fore.MAGENTA, 'Adjusting {site} resolution'.format(site=site), '{media} from {old} to {new}'.format(
+            media=change['title'], old=oldResolution, new=qualityProfiles[qualityProfileId]))
+        if item:
+            changed.append(dict(item, qualityProfileId=qualityProfileId))
+    return changed
+
+
+def RemoveMedia(change):
+    """Ask to remove a queued series/movie from sonarr/radarr, deleting its files"""
+    instance = GetInstance(change['isSeries'], change['instance'])
+    kind = change['isSeries'] and 'series' or 'movie'
+    # Nobody can answer without a terminal, e.g. under cron or a service manager
+    if not sys.stdin.isatty():
+        print(Fore.YELLOW + 'Not removing ' + kind + ' ' + change['title'] + ', no terminal to ask on' + Style.RESET_ALL)
+        return
+    answer = input('Remove ' + kind + ' ' + change['title'] + '? (y/N) ').lower()
+    if answer == 'y':
+        print(Fore.RED + 'Removing ' + kind + ': ' + change['title'] + Style.RESET_ALL)
+        try:
+            if change['isSeries']:
+                instance['api'].del_series(change['id'], delete_files=True)
+            else:
+                instance['api'].del_movie(change['id'], delete_files=True)
+        except Exception:
+            print(Fore.RED + 'Error while removing ' + kind + ': ' + change['title'] + Style.RESET_ALL)
+
+
+def ApplyArrChanges():
+    """Make every queued change to sonarr/radarr
+    Adds are searched for together once added, and profile changes are sent as one bulk edit per instance and profile
+    """
+    with changesLock:
+        changes = list(arrChanges.values())
+        arrChanges.clear()
+    # Items to update the libraries with, by instance name then id
+    updates = {}
+    # Added items to search for, by instance name
+    added = {}
+    # Profile changes, by instance name, is series and profile
+    profiles = {}
+
+    for change in changes:
+        instance = GetInstance(change['isSeries'], change['instance'])
+        if change['type'] == 'add':
+            item = AddMedia(change)
+            if item is not None:
+                updates.setdefault(instance['name'], (instance, {}))[1][item['id']] = item
+                added.setdefault(instance['name'], (instance, []))[1].append(item['id'])
+        elif change['type'] == 'profile':
+            profiles.setdefault((instance['name'], change['isSeries'], change['qualityProfileId']), []).append(change)
+
+    for instance, itemIds in added.values():
+        try:
+            SearchMedia(instance, itemIds)
+        except Exception as error:
+            PostDiscord(Fore.RED, 'Failed to search on ' + instance['name'].capitalize(), repr(error))
+    for (name, isSeries, qualityProfileId), profileChanges in profiles.items():
+        instance = GetInstance(isSeries, name)
+        for item in EditProfiles(instance, qualityProfileId, profileChanges):
+            updates.setdefault(instance['name'], (instance, {}))[1][item['id']] = item
+    for instance, items in updates.values():
+        UpdateLibraryItems(instance, items)
+
+    # Removals ask first, so come last
+    for change in changes:
+        if change['type'] == 'remove':
+            RemoveMedia(change)
 
 
 #################################
 ######## WRITE TO SHEETS ########
 #################################
 
-def CalculateQuota():
-    """Calculates the number of writes made in the last minute"""
-    currentquota = 0
-    for quota in cache['quota']:
-        if time.time() - quota < 60:
-            currentquota += 1
-    return currentquota
+# Seconds spent waiting on the sheets quota this sync, by bucket name
+quotaWaits = {}
 
 
-def WriteSheet(gsheet, title, func, cell, *args):
-    """Writes to the sheet with the given function and arguments"""
-    value = json.dumps([item for item in args]).replace('\n', ' ')
-    PostDiscordCell(Fore.YELLOW, sheet=title,
-                    cell=cell, type=func, footer=value)
+def TakeQuota(bucket):
+    """Takes a request from the buckets quota, waiting until one is available, returns the seconds waited
+    The bucket refills so that a full burst plus a minute of refills stays within the quota
+    """
+    refillRate = (sheetsQuota - sheetsQuotaBurst) / 60
+    waited = 0
+    while True:
+        # Update the bucket in an immediate transaction so other processes wait their turn
+        with cacheLock, cacheDb:
+            cacheDb.execute('BEGIN IMMEDIATE')
+            rows = cacheDb.execute(
+                'SELECT tokens, time FROM ratelimit WHERE name = ?', (bucket,)).fetchall()
+            now = time.time()
+            tokens = sheetsQuotaBurst
+            if rows:
+                tokens = min(sheetsQuotaBurst, rows[0][0] + (now - rows[0][1]) * refillRate)
+            wait = tokens < 1 and (1 - tokens) / refillRate or 0
+            if wait == 0:
+                cacheDb.execute('INSERT OR REPLACE INTO ratelimit VALUES (?, ?, ?)',
+                                (bucket, tokens - 1, now))
+        if wait == 0:
+            with metricsLock:
+                quotaWaits[bucket] = lstd(quotaWaits, bucket, 0) + waited
+            return waited
+        time.sleep(wait)
+        waited += wait
+
+
+def CallSheets(bucket, func, *args):
+    """Calls a google sheets function within the buckets quota, backing off and retrying if throttled"""
+    import gspread
+    for attempt in range(sheetsRetries):
+        TakeQuota(bucket)
+        try:
+            return TimeCall('sheets', func.__name__, func, *args)
+        except gspread.exceptions.APIError as error:
+            status = error.response.status_code
+            if status not in (429, 500, 503) or attempt == sheetsRetries - 1:
+                raise
+            # Wait as long as asked, else exponentially longer with jitter
+            retryAfter = error.response.headers.get('Retry-After', '')
+            delay = retryAfter.isdigit() and int(retryAfter) or min(
+                64, 2 ** attempt) + random.uniform(0, 1)
+            print(Fore.RED + 'Sheets request failed with ' + str(status) + ', retrying in ' +
+                  str(round(delay, 1)) + 's' + Style.RESET_ALL)
+            with metricsLock:
+                quotaWaits[bucket] = lstd(quotaWaits, bucket, 0) + delay
+            time.sleep(delay)
+
+
+# Writes waiting to be sent, by spreadsheet and sheet id then by row and column index, and the sheets they are for
+writeBuffer = {}
+bufferSheets = {}
+
+
+def BufferKey(gsheet):
+    """Get the write buffer key for a sheet, unique across spreadsheets"""
+    return gsheet.spreadsheet.id, gsheet.id
 
-    # Wait for quota to be below limit
-    currentquota = CalculateQuota()
-    if currentquota > 55:
-        while CalculateQuota() > 50:
-            time.sleep(5)
 
-    # Add current time to quota list and write cache
-    cache['quota'].append(time.time())
-    SaveCache()
+def WriteSheet(gsheet, title, func, cell, *args):
+    """Buffers a write to the sheet with the given function and arguments, sent with FlushSheet"""
+    value = json.dumps([item for item in args]).replace('\n', ' ')
 
-    # Run function with args
+    # Merge the write into any other writes to the same cell
+    rowIndex, columnIndex = a2n(cell)
+    bufferSheets[BufferKey(gsheet)] = gsheet
+    write = writeBuffer.setdefault(BufferKey(gsheet), {}).setdefault(
+        (rowIndex, columnIndex), {'cell': cell, 'cellData': {}, 'fields': [], 'changes': []})
+    write['changes'].append({'func': func, 'value': value})
+    fields = []
     if func == 'format':
-        gsheet.format(cell, *args)
-    elif func == 'update':
-        gsheet.update(cell, *args)
-    elif func == 'update_acell':
-        gsheet.update_acell(cell, *args)
+        write['cellData'].setdefault('userEnteredFormat', {}).update(args[0])
+        fields = ['userEnteredFormat.' + key for key in args[0]]
+    elif func == 'update' or func == 'update_acell':
+        # Empty values are cleared by being in the fields but not the cell data
+        text = str(args[0])
+        write['cellData'].pop('userEnteredValue', None)
+        if text != '':
+            write['cellData']['userEnteredValue'] = {
+                text.startswith('=') and 'formulaValue' or 'stringValue': text}
+        fields = ['userEnteredValue']
     elif func == 'insert_note':
-        gsheet.insert_note(cell, *args)
+        write['cellData']['note'] = args[0]
+        fields = ['note']
+    write['fields'] += [field for field in fields if field not in write['fields']]
+
+
+def WriteRange(gsheet, title, cell, values):
+    """Buffers writing text to a range of cells from cell as one update, values a list of rows of text, empty text clears the cell"""
+    rowIndex, columnIndex = a2n(cell)
+    bufferSheets[BufferKey(gsheet)] = gsheet
+    writeBuffer.setdefault(BufferKey(gsheet), {})[(rowIndex, columnIndex)] = {
+        'cell': cell,
+        'rows': [{'values': [text != '' and {'userEnteredValue': {'stringValue': text}} or {}
+                             for text in row]} for row in values],
+        'fields': ['userEnteredValue'],
+        'changes': [{'func': 'update_range', 'value': str(len(values)) + ' rows'}]
+    }
+
+
+def FlushSheet(gsheet, title):
+    """Sends all buffered writes for the sheet as a single batch update"""
+    writes = writeBuffer.pop(BufferKey(gsheet), {})
+    bufferSheets.pop(BufferKey(gsheet), None)
+    if len(writes) == 0:
+        return
+
+    batchRequests = []
+    for (rowIndex, columnIndex), write in writes.items():
+        batchRequests.append({
+            'updateCells': {
+                'start': {
+                    'sheetId': gsheet.id,
+                    'rowIndex': rowIndex,
+                    'columnIndex': columnIndex
+                },
+                'rows': lstd(write, 'rows', None) or [{'values': [write['cellData']]}],
+                'fields': ','.join(write['fields'])
+            }
+        })
+
+    start = time.time()
+    for write in writes.values():
+        for change in write['changes']:
+            PostDiscordCell(Fore.YELLOW, sheet=title, cell=write['cell'],
+                            type=change['func'], footer=change['value'])
+    cellCount = sum(len(row['values']) for request in batchRequests for row in request['updateCells']['rows'])
+    print(Fore.YELLOW + 'Writing ' + str(cellCount) +
+          ' cells to ' + title + Style.RESET_ALL)
+    CallSheets('write', gsheet.spreadsheet.batch_update, {'requests': batchRequests})
+    AddPhaseTime('write', start)
+
+
+def FlushSheets(gsheets):
+    """Sends the buffered writes of the sheets, sheetWorkers sheets at once sharing the write quota"""
+    gsheets = list(gsheets)
+    if len(gsheets) == 0:
+        return
+    with ThreadPoolExecutor(sheetWorkers) as pool:
+        for future in [pool.submit(FlushSheet, gsheet, gsheet.title) for gsheet in gsheets]:
+            future.result()
+
+
+def FlushAll():
+    """Sends the buffered writes of every sheet"""
+    FlushSheets(bufferSheets.values())
+
+
+def PlannedChanges():
+    """Get the buffered writes and queued sonarr/radarr changes as a dictionary that can be saved as json
+    quota, the sheets write requests applying it will use
+    writes, the cell writes, with the spreadsheet and sheet they are for, the cell, fields and cell data sent and the changes made
+    arr, the sonarr/radarr changes
+    """
+    writes = []
+    for key, sheetWrites in writeBuffer.items():
+        gsheet = bufferSheets[key]
+        for write in sheetWrites.values():
+            writes.append(dict(write, spreadsheet=gsheet.spreadsheet.id, spreadsheetTitle=gsheet.spreadsheet.title,
+                               sheetId=gsheet.id, sheet=gsheet.title))
+    with changesLock:
+        changes = list(arrChanges.values())
+    return {
+        'time': round(time.time()),
+        'quota': {'write': len([key for key in writeBuffer if len(writeBuffer[key]) > 0])},
+        'writes': writes,
+        'arr': changes
+    }
+
+
+def LoadPlan(plan):
+    """Buffer the writes and queue the sonarr/radarr changes of a saved plan, to send with FlushAll and ApplyArrChanges"""
+    worksheets = {}
+    for gspreadsheet in Authorise():
+        if gspreadsheet.id in {write['spreadsheet'] for write in plan['writes']}:
+            for gsheet in CallSheets('read', gspreadsheet.worksheets):
+                worksheets[BufferKey(gsheet)] = gsheet
+    for write in plan['writes']:
+        key = (write['spreadsheet'], write['sheetId'])
+        if key not in worksheets:
+            print(Fore.RED + 'Sheet ' + write['sheet'] + ' of the plan no longer exists' + Style.RESET_ALL)
+            continue
+        bufferSheets[key] = worksheets[key]
+        writeBuffer.setdefault(key, {})[a2n(write['cell'])] = {
+            field: value for field, value in write.items() if field not in ('spreadsheet', 'spreadsheetTitle', 'sheetId', 'sheet')}
+    for change in plan['arr']:
+        QueueArrChange(change)
 
 
 #################################
 ####### PROCESS SHEET DATA ######
 #################################
 
+# Series/movie fields that affect the sheets data
+fingerprintFields = ['id', 'title', 'year', 'status', 'titleSlug', 'qualityProfileId',
+                     'statistics', 'seasons', 'hasFile', 'sizeOnDisk', 'movieFile']
+
+
+def RowFingerprint(cellData, isSeries):
+    """Hash the rows cells with the series/movie fields that affect them, if unchanged the row needs no processing"""
+    instance, item = FindMedia(cellData[0].text, cellData[1].text, isSeries)
+    itemData = item and [instance['name'], ItemDigest(instance, item)]
+    cellStates = [cell.State() for cell in cellData]
+    return hashlib.sha1(json.dumps([cellStates, itemData], sort_keys=True).encode()).hexdigest()
+
+
+def RowKey(spreadsheet, title, cell):
+    """Get the key a row is cached by, the spreadsheet id, sheet title and first cell, e.g. ID!Dan!A5"""
+    return spreadsheet.id + '!' + title + '!' + cell
+
+
+def RowUnchanged(rowKey, fingerprint):
+    """Check if the row was up to date with the same fingerprint on a previous run"""
+    rowCache = GetRowCache(rowKey)
+    return syncOptions['incrementalSync'] and rowCache is not None and rowCache['fingerprint'] == fingerprint
+
+
+def RenderItem(item, isSeries):
+    """Work out the sheet values for a found series/movie
+    Returns a dictionary of the main note, status note, status text and colour, its fraction of files and its size
+    """
+    # Get media status and year
+    mainNote = str(item['year']) + '\n' + item['status'].capitalize()
+    if isSeries:
+        # Get series season episode count and size breakdown
+        seasonnotes = []
+        for season in item['seasons']:
+            seasonnumber = str(season['seasonNumber'])
+            seasonepisodes = str(season['statistics']['episodeFileCount']) + '/' + str(
+                season['statistics']['totalEpisodeCount'])
+            seasonsize = sizeof_fmt(season['statistics']['sizeOnDisk'])
+            seasonnotes.append('Season ' + seasonnumber + ':   ' + seasonepisodes + ' '*(
+                8 - (len(seasonepisodes) - 1)) + seasonsize)
+        statusNote = '\n'.join(seasonnotes)
+
+        # Series status data
+        fileCount = item['statistics']['episodeFileCount']
+        episodeCount = item['statistics']['episodeCount']
+        statusText = sizeof_fmt(
+            item['statistics']['sizeOnDisk']) + ' ' + str(fileCount) + '/' + str(episodeCount)
+
+        hasFile = episodeCount > 0 and fileCount / episodeCount or 0
+
+        statusTextColor = episodeCount == 0 and [1, 0, 0] or fileCount == episodeCount and [
+            0, 0.75, 0] or fileCount < episodeCount and [0.3, 0.3, 0] or [1, 0, 0]
+        fileSize = item['statistics']['sizeOnDisk']
+    else:
+        # Movie status data
+        statusText = sizeof_fmt(item['sizeOnDisk'])
+
+        resDifference = 0  # 0 if the same, 1 if above, -1 if below
+        hasFile = item['hasFile'] and 1 or 0  # For return
+        actualResNum = 0
+        if item['hasFile']:
+            radarrres = qualityProfiles[item['qualityProfileId']]
+            actualResNum = item['movieFile']['quality']['quality']['resolution']
+            targetresnum = qualityResolutions[radarrres]
+            if actualResNum == targetresnum:
+                resDifference = 0
+            elif actualResNum > targetresnum:
+                resDifference = 1
+            else:
+                resDifference = -1
+        # Green if has file and resolution matches, purple if resolution is too high, orange if resolution is too low, red if no file, red if file is missing
+        statusTextColor = item['hasFile'] and (resDifference == 0 and [0, 0.75, 0] or resDifference == 1 and [
+            0.5, 0.05, 0.75] or resDifference == -1 and [0.5, 0.5, 0]) or [1, 0, 0]
+
+        # Get required status notes
+        fileRes = str(actualResNum) + 'p'
+        statusNote = resDifference == 1 and 'Resolution of file is too high, file is ' + fileRes or resDifference == - \
+            1 and 'Resolution of file is too low, file is ' + \
+            fileRes or item['hasFile'] and 'Has file at correct resolution' or 'Missing file'
+        fileSize = item['sizeOnDisk']
+
+    return {
+        'mainNote': mainNote,
+        'statusNote': statusNote,
+        'statusText': statusText,
+        'statusTextColor': statusTextColor,
+        'hasFile': hasFile,
+        'fileSize': fileSize
+    }
+
+
+# Sheet values of each series/movie by instance name and id, as the item and digest they were worked out from and the values
+# Shared by every row and sheet, and cleared at the start of each sync
+renderCache = {}
+
+
+def ItemDigest(instance, item):
+    """Hash the series/movie fields that affect the sheets, once per item, returns the digest"""
+    key = (instance['name'], item['id'])
+    cached = renderCache.get(key)
+    if cached is not None and cached['item'] is item:
+        return cached['digest']
+    digest = hashlib.sha1(json.dumps({field: lstd(item, field, None) for field in fingerprintFields},
+                                     sort_keys=True).encode()).hexdigest()
+    # A new copy of unchanged data keeps its values
+    values = cached is not None and cached['digest'] == digest and cached['values'] or None
+    renderCache[key] = {'item': item, 'digest': digest, 'values': values}
+    return digest
+
+
+def RenderMedia(instance, item, isSeries):
+    """Get the sheet values for a found series/movie with RenderItem, worked out once per item and digest"""
+    ItemDigest(instance, item)
+    cached = renderCache[(instance['name'], item['id'])]
+    if cached['values'] is None:
+        cached['values'] = RenderItem(item, isSeries)
+    return cached['values']
+
+
 def ProcessSheetMedia(gsheet, title, isSeries, cellData):
     """
     Processes the sheets data and push any necessary changes to hyperlinks, notes, text color etc with data from sonarr/radarr
 
     title, the sheets title
     isSeries, a boolean for if the search is for a series or a movie
-    cellData, the data from the cell in the sheet, a list of the 3 cells, text, resolution and status, each contains a dictionary with, cell, text, hyperlink, note, textColor
+    cellData, the data from the cell in the sheet, a list of the 3 cells, text, resolution and status, each a CellState with cell, text, hyperlink, note, textColor
     """
-    mediaTitle = cellData[0]['text']
-    wantedResolution = cellData[1]['text']
+    mediaTitle = cellData[0].text
+    wantedResolution = cellData[1].text
+
+    # Skip the row if nothing changed since it was last found needing no writes
+    rowKey = RowKey(gsheet.spreadsheet, title, cellData[0].cell)
+    fingerprint = RowFingerprint(cellData, isSeries)
+    if RowUnchanged(rowKey, fingerprint):
+        rowCache = GetRowCache(rowKey)
+        return rowCache['fileSize'], rowCache['hasFile'], mediaTitle != ''
+    writeCount = len(lstd(writeBuffer, BufferKey(gsheet), {}))
 
     # Variables for what the sheets data should be
     wantedMainHyperlink = ''
@@ -370,11 +1712,14 @@ def ProcessSheetMedia(gsheet, title, isSeries, cellData):
 
     fileSize = 0  # Size of media file(s)
     hasFile = 0  # 0 if no file, 1 if file exists
+    queuedChange = False  # If a sonarr/radarr change is queued for the row
 
     # Search the sites for the media
     if mediaTitle != '':
-        result, item = SearchAgainstSite(
+        LearnSuggestion(rowKey, mediaTitle, isSeries)
+        result, item, instance = SearchAgainstSite(
             mediaTitle, wantedResolution, isSeries)
+        queuedChange = result == 'adding'
 
         duped = False
         dupedList = []
@@ -388,136 +1733,86 @@ def ProcessSheetMedia(gsheet, title, isSeries, cellData):
         # Get required notes
         if result == 'failedmatch':
             # Couldn't match message to series alternative names
-            wantedMainNote = "Couldn't match, did you mean\n" + '\n'.join(item)
+            wantedMainNote = "Couldn't match, did you mean\n" + \
+                '\n'.join(suggestion['title'] for suggestion in item)
+            SaveSuggestions(rowKey, mediaTitle, item)
         elif result == 'adding':
             # Adding message
             wantedMainNote = 'Not on {site} yet, will be added automatically soon'.format(
-                site=isSeries and 'Sonarr' or 'Radarr')
+                site=instance['name'].capitalize())
         elif result == 'found':
-            # Get media status and year
-            wantedMainNote = str(item['year']) + \
-                '\n' + item['status'].capitalize()
+            # Get media status and year, status text, notes and color, the same for every row the media is on
+            rendered = RenderMedia(instance, item, isSeries)
+            wantedMainNote = rendered['mainNote']
+            wantedStatusText = rendered['statusText']
+            wantedStatusNote = rendered['statusNote']
+            wantedStatusTextColor = rendered['statusTextColor']
+            hasFile = rendered['hasFile']
+            fileSize += rendered['fileSize']
         if duped:
             # If media is duped, add that to the note
             wantedMainNote += '\nThis exists on multiple sheets: ' + \
                 ', '.join(dupedList)
 
-        # Get required status notes
-        if result == 'found':
-            if isSeries:
-                # Get series season episode count and size breakdown
-                seasonnotes = []
-                for season in item['seasons']:
-                    seasonnumber = str(season['seasonNumber'])
-                    seasonepisodes = str(season['statistics']['episodeFileCount']) + '/' + str(
-                        season['statistics']['totalEpisodeCount'])
-                    seasonsize = sizeof_fmt(season['statistics']['sizeOnDisk'])
-                    seasonnotes.append('Season ' + seasonnumber + ':   ' + seasonepisodes + ' '*(
-                        8 - (len(seasonepisodes) - 1)) + seasonsize)
-                wantedStatusNote = '\n'.join(seasonnotes)
-
         # Get required resolution value
         if result == 'found':
             # The resolution of the media on the site
             wantedResolutionText = qualityProfiles[item['qualityProfileId']]
-            if wantedResolutionText != cellData[1]['text'] and not shouldPullResolution:
-                # Adjust resolution on sonarr or radarr
-                cellQuality = cellData[1]['text']
+            if wantedResolutionText != cellData[1].text and not shouldPullResolution:
+                # Queue adjusting the resolution on sonarr or radarr
+                cellQuality = cellData[1].text
                 if cellQuality in qualityFromProfile:
-                    wantedQuality = qualityFromProfile[cellData[1]['text']]
-                    params = item
-                    params['profileId'] = wantedQuality
-                    params['qualityProfileId'] = wantedQuality
-                    if isSeries:
-                        sonarrapi.upd_series(params)
-                    else:
-                        radarrapi.upd_movie(params)
-                    # Send debug message to discord
-                    PostDiscord(Fore.MAGENTA, 'Adjusting {site} resolution'.format(site=isSeries and 'Sonarr' or 'Radarr'), '{media} from {old} to {new}'.format(
-                        media=mediaTitle, old=wantedResolutionText, new=cellData[1]['text']))
+                    QueueArrChange({
+                        'type': 'profile',
+                        'isSeries': isSeries,
+                        'instance': instance['name'],
+                        'title': mediaTitle,
+                        'id': item['id'],
+                        'qualityProfileId': qualityFromProfile[cellQuality]
+                    })
+                    queuedChange = True
 
         # Get required hyperlink value
         if result == 'found':
-            wantedMainHyperlink = (
-                isSeries and 'http://sonarr.ratatoskr.uk/series/' or 'http://radarr.ratatoskr.uk/movie/') + item['titleSlug']
-
-        # Get required status text and color
-        if result == 'found':
-            if isSeries:
-                # Series status data
-                fileCount = item['statistics']['episodeFileCount']
-                episodeCount = item['statistics']['episodeCount']
-                wantedStatusText = sizeof_fmt(
-                    item['statistics']['sizeOnDisk']) + ' ' + str(fileCount) + '/' + str(episodeCount)
-
-                hasFile = episodeCount > 0 and fileCount / episodeCount or 0
-
-                wantedStatusTextColor = episodeCount == 0 and [1, 0, 0] or fileCount == episodeCount and [
-                    0, 0.75, 0] or fileCount < episodeCount and [0.3, 0.3, 0] or [1, 0, 0]
-            else:
-                # Movie status data
-                wantedStatusText = sizeof_fmt(item['sizeOnDisk'])
-
-                resDifference = 0  # 0 if the same, 1 if above, -1 if below
-                hasFile = item['hasFile'] and 1 or 0  # For return
-                actualResNum = 0
-                if item['hasFile']:
-                    radarrres = qualityProfiles[item['qualityProfileId']]
-                    actualResNum = item['movieFile']['quality']['quality']['resolution']
-                    targetresnum = qualityResolutions[radarrres]
-                    if actualResNum == targetresnum:
-                        resDifference = 0
-                    elif actualResNum > targetresnum:
-                        resDifference = 1
-                    else:
-                        resDifference = -1
-                # Green if has file and resolution matches, purple if resolution is too high, orange if resolution is too low, red if no file, red if file is missing
-                wantedStatusTextColor = item['hasFile'] and (resDifference == 0 and [0, 0.75, 0] or resDifference == 1 and [
-                                                             0.5, 0.05, 0.75] or resDifference == -1 and [0.5, 0.5, 0]) or [1, 0, 0]
-
-                # Get required status notes
-                fileRes = str(actualResNum) + 'p'
-                wantedStatusNote = resDifference == 1 and 'Resolution of file is too high, file is ' + fileRes or resDifference == - \
-                    1 and 'Resolution of file is too low, file is ' + \
-                    fileRes or item['hasFile'] and 'Has file at correct resolution' or 'Missing file'
-
-        # Add total size variable
-        if result == 'found':
-            if isSeries:
-                fileSize += item['statistics']['sizeOnDisk']
-            else:
-                fileSize += item['sizeOnDisk']
+            wantedMainHyperlink = instance['link'] + item['titleSlug']
 
     # Update the sheets data where necessary
-    if cellData[0]['note'] != wantedMainNote:
+    if cellData[0].note != wantedMainNote:
         WriteSheet(gsheet, title, 'insert_note',
-                   cellData[0]['cell'], wantedMainNote)
-    if cellData[0]['hyperlink'] != wantedMainHyperlink:
-        WriteSheet(gsheet, title, 'update_acell', cellData[0]['cell'], '=HYPERLINK("' +
+                   cellData[0].cell, wantedMainNote)
+    if cellData[0].hyperlink != wantedMainHyperlink:
+        import titlecase
+        WriteSheet(gsheet, title, 'update_acell', cellData[0].cell, '=HYPERLINK("' +
                    wantedMainHyperlink + '", "' + titlecase.titlecase(mediaTitle) + '")')
-    if not fuzzyMatchList(cellData[0]['textColor'], wantedMainTextColor):
-        WriteSheet(gsheet, title, 'format', cellData[0]['cell'], {'textFormat': {'bold': True, 'foregroundColor': {
+    if not fuzzyMatchList(cellData[0].textColor, wantedMainTextColor):
+        WriteSheet(gsheet, title, 'format', cellData[0].cell, {'textFormat': {'bold': True, 'foregroundColor': {
                    'red': wantedMainTextColor[0], 'green': wantedMainTextColor[1], 'blue': wantedMainTextColor[2]}, 'link': {'uri': wantedMainHyperlink}}})
 
     # Write 1080p to any blank cells, and pull to sheet if that option is enabled
-    if mediaTitle == '' and cellData[1]['text'] != '1080p':
-        WriteSheet(gsheet, title, 'update', cellData[1]['cell'], '1080p')
+    if mediaTitle == '' and cellData[1].text != '1080p':
+        WriteSheet(gsheet, title, 'update', cellData[1].cell, '1080p')
     else:
         if shouldPullResolution:
-            if cellData[1]['text'] != wantedResolutionText:
+            if cellData[1].text != wantedResolutionText:
                 WriteSheet(gsheet, title, 'update',
-                           cellData[1]['cell'], wantedResolutionText)
+                           cellData[1].cell, wantedResolutionText)
 
-    if cellData[2]['note'] != wantedStatusNote:
+    if cellData[2].note != wantedStatusNote:
         WriteSheet(gsheet, title, 'insert_note',
-                   cellData[2]['cell'], wantedStatusNote)
-    if cellData[2]['text'] != wantedStatusText:
+                   cellData[2].cell, wantedStatusNote)
+    if cellData[2].text != wantedStatusText:
         WriteSheet(gsheet, title, 'update',
-                   cellData[2]['cell'], wantedStatusText)
-    if not fuzzyMatchList(cellData[2]['textColor'], wantedStatusTextColor):
-        WriteSheet(gsheet, title, 'format', cellData[2]['cell'], {'textFormat': {'bold': True, 'foregroundColor': {
+                   cellData[2].cell, wantedStatusText)
+    if not fuzzyMatchList(cellData[2].textColor, wantedStatusTextColor):
+        WriteSheet(gsheet, title, 'format', cellData[2].cell, {'textFormat': {'bold': True, 'foregroundColor': {
                    'red': wantedStatusTextColor[0], 'green': wantedStatusTextColor[1], 'blue': wantedStatusTextColor[2]}}})
 
+    # Remember the row if it is up to date, else it is checked again once the writes and changes are made
+    if len(lstd(writeBuffer, BufferKey(gsheet), {})) == writeCount and not queuedChange:
+        SetRowCache(rowKey, fingerprint, fileSize, hasFile)
+    else:
+        SetRowCache(rowKey, None, 0, 0)
+
     return fileSize, hasFile, mediaTitle != ''
 
 
@@ -525,256 +1820,801 @@ def ProcessSheetMedia(gsheet, title, isSeries, cellData):
 ######## GRAB SHEET DATA ########
 #################################
 
-# List all worksheets
-start = time.time()
-params = {
-    # "ranges": "'Dan'",
-    "spreadsheetId": gspreadsheet.id,
-    "includeGridData": True
-}
-
-# Get data from cache or sheets
-sheetsDict = {}
-sheetsData = gspreadsheet._spreadsheets_get(params)
-
-# Data for series, movies count and sizes
-sheetSeriesData = {}
-sheetMoviesData = {}
-# List for items that are not on the sheet, and items that are duplicates on the sheets
-missingSheetSeries = []
-missingSheetSeriesIds = []
-duplicateSheetSeries = {}
-missingSheetMovies = []
-missingSheetMoviesIds = []
-duplicateSheetMovies = {}
-
-
-def GetMissingMedia():
-    """Get lists of series and movies on the site but not on the sheet"""
-    for siteItem in sonarrList:
-        found = False
-        for sheetItem in sheetSeriesData:
-            if TitleMatch(sheetItem, siteItem['title'], siteItem['year']):
-                found = True
-                break
-        if not found:
-            missingSheetSeries.append(siteItem['title'])
-            missingSheetSeriesIds.append(siteItem['id'])
-
-    for siteItem in radarrList:
-        found = False
-        for sheetItem in sheetMoviesData:
-            if TitleMatch(sheetItem, siteItem['title'], siteItem['year']):
-                found = True
-                break
-        if not found:
-            missingSheetMovies.append(siteItem['title'])
-            missingSheetMoviesIds.append(siteItem['id'])
-
-
-for sheet in sheetsData['sheets']:
-    gsheet = gspreadsheet.get_worksheet_by_id(sheet['properties']['sheetId'])
-    # Get data about the sheet
-    properties = sheet['properties']
-    sheetTitle = properties['title']
-    rowCount = properties['gridProperties']['rowCount']
-    columnCount = properties['gridProperties']['columnCount']
-
-    print(Fore.YELLOW + 'Sheet: ' + sheetTitle + Style.RESET_ALL)
-
-    # Start dictionary
-    sheetsDict[sheetTitle] = {
-        'properties': {
-            'rowCount': rowCount,
-            'columnCount': columnCount
-        },
-        'rows': []
+# Number of columns used on the info sheet and the users sheets
+infoColumnCount = 4
+mediaColumnCount = 6
+
+# Only the cell properties that are read from the sheets
+sheetsFields = 'sheets(properties(sheetId,title,gridProperties(rowCount,columnCount)),' + \
+    'data(startRow,startColumn,rowData(values(formattedValue,note,hyperlink,' + \
+    'userEnteredFormat(textFormat(foregroundColorStyle))))))'
+
+
+# Column letters for the first 702 columns, A to ZZ
+columnLetters = [n2a(n) for n in range(702)]
+
+
+class CellState:
+    """A cell of a sheet, read from the sheets response as its values are used
+    cell, the cells address, e.g. A5
+    text, note, hyperlink, the cells values or '' if empty
+    textColor, the cells text colour as a list of red, green, blue from 0 to 1
+    """
+    __slots__ = ('column', 'rowIndex', 'columnIndex')
+
+    def __init__(self, column, rowIndex, columnIndex):
+        self.column = column
+        self.rowIndex = rowIndex
+        self.columnIndex = columnIndex
+
+    @property
+    def cell(self):
+        letter = self.columnIndex < len(columnLetters) and columnLetters[self.columnIndex] or n2a(self.columnIndex)
+        return letter + str(self.rowIndex + 1)
+
+    @property
+    def text(self):
+        return lstd(self.column, 'formattedValue')
+
+    @property
+    def note(self):
+        return lstd(self.column, 'note')
+
+    @property
+    def hyperlink(self):
+        return lstd(self.column, 'hyperlink')
+
+    @property
+    def textColor(self):
+        textFormat = lstd(lstd(self.column, 'userEnteredFormat', {}), 'textFormat', {})
+        if 'foregroundColorStyle' not in textFormat:
+            return [0, 0, 0]
+        textColorList = lstd(textFormat['foregroundColorStyle'], 'rgbColor', {})
+        return [lstd(textColorList, 'red', 0), lstd(textColorList, 'green', 0), lstd(textColorList, 'blue', 0)]
+
+    def State(self):
+        """Get all the cells values as a dictionary"""
+        return {
+            'cell': self.cell,
+            'text': self.text,
+            'note': self.note,
+            'hyperlink': self.hyperlink,
+            'textColor': self.textColor
+        }
+
+
+class SheetRow:
+    """A row of a sheet from the sheets response, keeping only the used columns and creating cells as they are indexed"""
+    __slots__ = ('values', 'rowIndex', 'startColumn', 'columnCount')
+
+    def __init__(self, row, rowIndex, startColumn, columnCount):
+        self.values = lstd(row, 'values', [])[:columnCount]
+        self.rowIndex = rowIndex
+        self.startColumn = startColumn
+        self.columnCount = columnCount
+
+    def __len__(self):
+        return self.columnCount
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[x] for x in range(*index.indices(self.columnCount))]
+        if index >= self.columnCount:
+            raise IndexError(index)
+        column = index < len(self.values) and self.values[index] or {}
+        return CellState(column, self.rowIndex, self.startColumn + index)
+
+
+def GetSheetsData(gspreadsheet):
+    """Get the sheets data for the used columns of every worksheet of the spreadsheet, and the worksheets by id"""
+    start = time.time()
+    worksheets = {}
+    sheetRanges = []
+    for worksheet in CallSheets('read', gspreadsheet.worksheets):
+        worksheets[worksheet.id] = worksheet
+        columnCount = worksheet.title == 'Info' and infoColumnCount or mediaColumnCount
+        sheetRanges.append("'" + worksheet.title.replace("'", "''") +
+                           "'!A:" + n2a(columnCount - 1))
+    params = {
+        "spreadsheetId": gspreadsheet.id,
+        "includeGridData": True,
+        "ranges": sheetRanges,
+        "fields": sheetsFields
     }
+    sheetsData = CallSheets('read', gspreadsheet._spreadsheets_get, params)
+    AddPhaseTime('read', start)
+    return sheetsData, worksheets
+
 
-    # Get the data from the sheet
+def RowSearches(gspreadsheet, sheetTitle, rows):
+    """Get the titles in rows of a users sheet that need searching for, not on the sites, cached, closely matching the sites, or in unchanged rows
+    Returns a dictionary of lookup key to name and is series
+    """
+    searches = {}
+    for cells in rows:
+        if cells.rowIndex == 0:
+            continue
+        for isSeries, cellData in ((True, cells[0:3]), (False, cells[3:6])):
+            name = cellData[0].text
+            if name == '' or FindMedia(name, cellData[1].text, isSeries)[1] is not None:
+                continue
+            if GetCachedLookup(name, isSeries) is not None or RowUnchanged(
+                    RowKey(gspreadsheet, sheetTitle, cellData[0].cell), RowFingerprint(cellData, isSeries)):
+                continue
+            if LookupKey(name, isSeries) in aliases or ResolveLibrary(name, isSeries):
+                continue
+            searches[LookupKey(name, isSeries)] = (name, isSeries)
+    return searches
+
+
+def GetSearches(gspreadsheet, sheetsData):
+    """Get the titles on the users sheets that need searching for, as a list of name and is series pairs"""
+    searches = {}
+    for sheet in sheetsData['sheets']:
+        sheetTitle = sheet['properties']['title']
+        if sheetTitle != 'Info':
+            searches.update(RowSearches(gspreadsheet, sheetTitle, SheetRows(sheet)))
+    return list(searches.values())
+
+
+# Rows each series/movie is on from the last sync, by instance name and item id, to a list of worksheet and row index
+# Rows not on the sites yet are kept by is series and normalised title until their add reaches the sites
+sheetMediaRows = {}
+
+
+def GetMissingMedia(names, isSeries):
+    """Get a list of title, instance and id for series or movies on the sites but not matched by any of the normalised names"""
+    missing = []
+    for instance in Instances(isSeries):
+        index = instance['index']
+        # Names are matched by title, else by a learned alias
+        sheetItems = [index.get(key) or index.get(aliases.get(LookupKey(key, isSeries)))
+                      for key in names]
+        sheetIds = {item['id'] for item in sheetItems if item is not None}
+        for siteItem in instance['list']:
+            if siteItem['id'] not in sheetIds:
+                missing.append((siteItem['title'], instance, siteItem['id']))
+    return missing
+
+
+def MediaKey(name, resolution, isSeries):
+    """Get the key a series/movie is counted by across the sheets, its tvdb/tmdb id if on the sites, else its normalised title
+    e.g. 'The Office' and 'the office 2005' -> 'tvdb:73244', 'Not Added Yet' -> 'not added yet'
+    """
+    instance, item = FindMedia(name, resolution, isSeries)
+    return item is not None and ItemKey(item, isSeries) or NormaliseTitle(name)
+
+
+def TotalText(count, files, size):
+    """Get the text for a count of series/movies, the percentage of files they have and their size, e.g. 10 - 50%\n1.0GiB"""
+    return count == 0 and 'N/A' or str(count) + ' - ' + str(
+        round(files/count*100)) + '%\n' + str(sizeof_fmt(size))
+
+
+def AggregateSheets(sheetMedia, missing):
+    """Work out the info sheets data in one pass once every users sheet is processed
+    sheetMedia, by is series then media key, the series/movies on the users sheets as their first name, all names, size, files and the sheets they are on
+    missing, by is series, the series/movies on no sheet of any spreadsheet from MissingMedia
+
+    Returns a dictionary, each by is series, of
+    missing, title, instance and id for series/movies on the sites but on no sheet
+    duplicates, the text for series/movies on more than one sheet, e.g. 'The Office (Dan, Sam)'
+    totals, the count, files and size of the series/movies on the sheets
+    """
+    aggregate = {'missing': missing, 'duplicates': {}, 'totals': {}}
+    for isSeries, media in sheetMedia.items():
+        files, size = 0, 0
+        duplicates = []
+        for entry in media.values():
+            files += entry['files']
+            size += entry['size']
+            if len(entry['sheets']) > 1:
+                duplicates.append(entry['name'] + ' (' + ', '.join(entry['sheets']) + ')')
+        aggregate['duplicates'][isSeries] = duplicates
+        aggregate['totals'][isSeries] = (len(media), files, size)
+    return aggregate
+
+
+def MissingMedia(spreadsheetsMedia):
+    """Get the series/movies on the sites but on no sheet of any spreadsheet, by is series, as every spreadsheet shares the sites
+    spreadsheetsMedia, the series/movies on the users sheets of each spreadsheet, by is series then media key
+    """
+    missing = {}
+    for isSeries in (True, False):
+        names = set()
+        for sheetMedia in spreadsheetsMedia:
+            for entry in sheetMedia[isSeries].values():
+                names.update(entry['names'])
+        missing[isSeries] = GetMissingMedia(names, isSeries)
+    return missing
+
+
+def FetchSpreadsheet(gspreadsheet):
+    """Download the spreadsheets data and search for any new titles on it, returns the sheets data and worksheets by id"""
+    sheetsData, worksheets = GetSheetsData(gspreadsheet)
+    PrefetchLookups(GetSearches(gspreadsheet, sheetsData))
+    return sheetsData, worksheets
+
+
+def PlanSheet(gsheet, sheetTitle, rows):
+    """Process the rows of a users sheet against the sites data, buffering any changes
+    rows, a list or generator of SheetRow from the first row of the sheet
+    Returns the series/movies on the sheet, by is series then media key, to merge with MergeSheetMedia
+    """
+    start = time.time()
+    sheetMedia = {True: {}, False: {}}
+    totals = {True: [0, 0, 0], False: [0, 0, 0]}
+    # Rows can be a list or a generator, the first row holds the totals
+    rows = iter(rows)
+    header = next(rows)
+    for cells in rows:
+        for isSeries, cellData in ((True, cells[0:3]), (False, cells[3:6])):
+            size, files, count = ProcessSheetMedia(gsheet, sheetTitle, isSeries, cellData)
+            totals[isSeries][0] += count
+            totals[isSeries][1] += files
+            totals[isSeries][2] += size
+            name = cellData[0].text
+            if name != '':
+                instance, item = FindMedia(name, cellData[1].text, isSeries)
+                rowsKey = item is not None and (instance['name'], item['id']) or (isSeries, NormaliseTitle(name))
+                sheetMediaRows.setdefault(rowsKey, []).append((gsheet, cells.rowIndex))
+                entry = sheetMedia[isSeries].setdefault(MediaKey(name, cellData[1].text, isSeries), {
+                    'name': name, 'names': set(), 'size': size, 'files': files, 'sheets': []})
+                entry['names'].add(NormaliseTitle(name))
+                entry['sheets'].append(sheetTitle)
+
+    # First row, push the total sizes to the sheet
+    wantedTextSeries = TotalText(*totals[True])
+    wantedTextMovies = TotalText(*totals[False])
+    if header[2].text != wantedTextSeries:
+        WriteSheet(gsheet, sheetTitle, 'update', 'C1', wantedTextSeries)
+    if header[5].text != wantedTextMovies:
+        WriteSheet(gsheet, sheetTitle, 'update', 'F1', wantedTextMovies)
+    AddPhaseTime('process', start)
+    return sheetMedia
+
+
+def SyncSheet(gsheet, sheetTitle, rows):
+    """Process a users sheet with PlanSheet and send its writes as soon as it is done, returns the series/movies on the sheet"""
+    media = PlanSheet(gsheet, sheetTitle, rows)
+    FlushSheet(gsheet, sheetTitle)
+    return media
+
+
+def MergeSheetMedia(sheetMedia, media):
+    """Merge the series/movies of a sheet into those of the sheets before it"""
+    for isSeries, entries in media.items():
+        for key, entry in entries.items():
+            if key in sheetMedia[isSeries]:
+                sheetMedia[isSeries][key]['names'].update(entry['names'])
+                sheetMedia[isSeries][key]['sheets'] += entry['sheets']
+            else:
+                sheetMedia[isSeries][key] = entry
+
+
+def PlanInfo(gsheet, rows, aggregate):
+    """Buffer the info sheets totals, and its missing and duplicate columns from row 5 as one range update"""
+    wantedTextSeries = TotalText(*aggregate['totals'][True])
+    wantedTextMovies = TotalText(*aggregate['totals'][False])
+    if rows[1][0].text != wantedTextSeries:
+        WriteSheet(gsheet, 'Info', 'update', 'A2:B2', wantedTextSeries)
+    if rows[1][2].text != wantedTextMovies:
+        WriteSheet(gsheet, 'Info', 'update', 'C2:D2', wantedTextMovies)
+
+    # Missing series, duplicate series, missing movies and duplicate movies, as far as the sheet goes
+    columns = [[missing[0] for missing in aggregate['missing'][True]], aggregate['duplicates'][True],
+               [missing[0] for missing in aggregate['missing'][False]], aggregate['duplicates'][False]]
+    infoRows = rows[4:]
+    wanted = [[y < len(column) and column[y] or '' for column in columns] for y in range(len(infoRows))]
+    current = [[cell.text for cell in cells[0:4]] for cells in infoRows]
+    if wanted != current:
+        # Only rows up to the last with text on the sheet or to write are sent
+        usedCount = max([y + 1 for y in range(len(infoRows)) if any(wanted[y]) or any(current[y])] or [0])
+        WriteRange(gsheet, 'Info', 'A5', wanted[:usedCount])
+
+    # If has remove argument, queue asking to remove the series/movies
+    if syncOptions['removeMissing']:
+        for isSeries in (True, False):
+            for title, instance, id in aggregate['missing'][isSeries]:
+                QueueArrChange({'type': 'remove', 'isSeries': isSeries, 'instance': instance['name'],
+                                'title': title, 'id': id})
+
+
+def InfoDue(gspreadsheet):
+    """Check if the spreadsheets info sheet is due a refresh
+    Removing needs the info sheets missing list, so it is always refreshed then
+    """
+    return syncOptions['removeMissing'] or time.time() - GetMeta('infoRefresh' + gspreadsheet.id) >= infoRefreshTime
+
+
+def PlanInfoSheet(gspreadsheet, gsheet, rows, sheetMedia, missing):
+    """Process the info sheet from the series/movies found on the users sheets, buffering any changes"""
+    print(Fore.YELLOW + 'Sheet: ' + gspreadsheet.title + ' - Info' + Style.RESET_ALL)
+    start = time.time()
+    PlanInfo(gsheet, rows, AggregateSheets(sheetMedia, missing))
+    SetMeta('infoRefresh' + gspreadsheet.id, time.time())
+    AddPhaseTime('process', start)
+
+
+def PlanInfoSheets(planned):
+    """Process the info sheets once the users sheets of every spreadsheet are processed, so missing means on no spreadsheet
+    planned, for each spreadsheet, the spreadsheet and what PlanSpreadsheet or StreamSpreadsheet returned
+    """
+    missing = MissingMedia([sheetMedia for gspreadsheet, (infoSheet, sheetMedia) in planned])
+    for gspreadsheet, (infoSheet, sheetMedia) in planned:
+        if infoSheet is not None:
+            PlanInfoSheet(gspreadsheet, *infoSheet, sheetMedia, missing)
+
+
+def SheetRows(sheet):
+    """Get the rows of a sheet from the sheets data, as a list of SheetRow up to the sheets size"""
+    rowCount = sheet['properties']['gridProperties']['rowCount']
     startRow = lstd(sheet['data'][0], 'startRow', 0)
     startColumn = lstd(sheet['data'][0], 'startColumn', 0)
-    rowData = sheet['data'][0]['rowData']
-
-    totalSeriesSize, totalSeriesFiles, totalSeriesCount = 0, 0, 0
-    totalMoviesSize, totalMoviesFiles, totalMoviesCount = 0, 0, 0
-
-    if sheetTitle == 'Info':
-        # Remove all items that are only on one sheet
-        duplicateSheetSeries = {
-            i: j for i, j in duplicateSheetSeries.items() if len(j) > 1}
-        duplicateSheetMovies = {
-            i: j for i, j in duplicateSheetMovies.items() if len(j) > 1}
-        GetMissingMedia()
-
-    # Loop through all rows and get indexes
-    for y, row in enumerate(rowData):
-        rowIndex = startRow + y
-        # Write row to dictionary
-        sheetsDict[sheetTitle]['rows'].append({'cells': []})
-
-        # Loop through all columns and get indexes
-        for x, column in enumerate(row['values']):
-            columnIndex = startColumn + x
-
-            # Get cell data
-            formattedValue = lstd(column, 'formattedValue')
-            note = lstd(column, 'note')
-            hyperlink = lstd(column, 'hyperlink')
-            # Get text rgb
-            textColor = [0, 0, 0]
-            if 'userEnteredFormat' in column and 'textFormat' in column['userEnteredFormat'] and 'foregroundColorStyle' in column['userEnteredFormat']['textFormat']:
-                textColorList = column['userEnteredFormat']['textFormat']['foregroundColorStyle']['rgbColor']
-                textColor = [lstd(textColorList, 'red', 0), lstd(
-                    textColorList, 'green', 0), lstd(textColorList, 'blue', 0)]
-
-            # Write data to dictionary
-            sheetsDict[sheetTitle]['rows'][rowIndex]['cells'].append({
-                'cell': n2a(columnIndex) + str(rowIndex + 1),
-                'text': formattedValue,
-                'note': note,
-                'hyperlink': hyperlink,
-                'textColor': textColor
-            })
-
-        if sheetTitle == 'Info':
-            # Process the info sheet, requires being last processed
-            if rowIndex > 3:
-                rowData = sheetsDict[sheetTitle]['rows'][rowIndex]['cells']
-                # Set missing series
-                removeSeries = (len(missingSheetSeries) > rowIndex -
-                                4) and missingSheetSeries[rowIndex - 4] or ''
-                if rowData[0]['text'] != removeSeries:
-                    WriteSheet(gsheet, sheetTitle, 'update',
-                               rowData[0]['cell'], removeSeries)
-
-                # If has remove argument, ask to remove series
-                if removeSeries != '':
-                    if '--remove' in sys.argv or '-r' in sys.argv:
-                        # Ask user
-                        answer = input('Remove series ' + str(removeSeries + '? (y/N) ')).lower()
-                        if answer == 'y':
-                            id = missingSheetSeriesIds[rowIndex - 4]
-                            print(Fore.RED + 'Removing series: ' + removeSeries + Style.RESET_ALL)
-                            try:
-                                sonarrapi.del_series(id, delete_files=True)
-                            except:
-                                print(Fore.RED + 'Error while removing series: ' + removeSeries + Style.RESET_ALL)
-
-                # Set dupe series text or nothing
-                dupeSeriesName, dupeSeriesSheets, dupeSeriesText = '', [], ''
-                if len(duplicateSheetSeries) > rowIndex - 4:
-                    dupeSeriesName, dupeSeriesSheets = list(duplicateSheetSeries.keys())[
-                        rowIndex - 4], list(duplicateSheetSeries.values())[rowIndex - 4]
-                    dupeSeriesText = dupeSeriesName + \
-                        ' (' + ', '.join(dupeSeriesSheets) + ')'
-                if rowData[1]['text'] != dupeSeriesText:
-                    WriteSheet(gsheet, sheetTitle, 'update',
-                               rowData[1]['cell'], dupeSeriesText)
-
-                # Set missing movies
-                removeMovies = (len(missingSheetMovies) > rowIndex -
-                                4) and missingSheetMovies[rowIndex - 4] or ''
-                if rowData[2]['text'] != removeMovies:
-                    WriteSheet(gsheet, sheetTitle, 'update',
-                               rowData[2]['cell'], removeMovies)
-
-                # If has remove argument, ask to remove movies
-                if removeMovies != '':
-                    if '--remove' in sys.argv or '-r' in sys.argv:
-                        # Ask user
-                        answer = input('Remove movie ' + str(removeMovies + '? (y/N) ')).lower()
-                        if answer == 'y':
-                            id = missingSheetMoviesIds[rowIndex - 4]
-                            print(Fore.RED + 'Removing movie: ' + removeMovies + Style.RESET_ALL)
-                            try:
-                                radarrapi.del_movie(id, delete_files=True)
-                            except:
-                                print(Fore.RED + 'Error while removing movie: ' + removeMovies + Style.RESET_ALL)
-
-                # Set dupe movies text or nothing
-                dupeMoviesName, dupeMoviesSheets, dupeMoviesText = '', [], ''
-                if len(duplicateSheetMovies) > rowIndex - 4:
-                    dupeMoviesName, dupeMoviesSheets = list(duplicateSheetMovies.keys())[
-                        rowIndex - 4], list(duplicateSheetMovies.values())[rowIndex - 4]
-                    dupeMoviesText = dupeMoviesName + \
-                        ' (' + ', '.join(dupeMoviesSheets) + ')'
-                if rowData[3]['text'] != dupeMoviesText:
-                    WriteSheet(gsheet, sheetTitle, 'update',
-                               rowData[3]['cell'], dupeMoviesText)
+    rowData = lstd(sheet['data'][0], 'rowData', [])
+    usedColumnCount = sheet['properties']['title'] == 'Info' and infoColumnCount or mediaColumnCount
 
-        else:
-            # For every non info sheet
-            if rowIndex > 0:
-                # Series cells
-                seriesSize, seriesFile, seriesCount = ProcessSheetMedia(
-                    gsheet, sheetTitle, True, sheetsDict[sheetTitle]['rows'][rowIndex]['cells'][0:3])
-                totalSeriesSize += seriesSize
-                totalSeriesFiles += seriesFile
-                totalSeriesCount += seriesCount
-                seriesName = lstd(
-                    sheetsDict[sheetTitle]['rows'][rowIndex]['cells'][0], 'text')
-                if seriesName != '':
-                    if seriesName in duplicateSheetSeries:
-                        duplicateSheetSeries[seriesName].append(sheetTitle)
-                    else:
-                        duplicateSheetSeries[seriesName] = [sheetTitle]
-                    sheetSeriesData[seriesName] = {
-                        'size': seriesSize,
-                        'files': seriesFile
-                    }
-
-                # Movies cells
-                moviesSize, moviesFile, moviesCount = ProcessSheetMedia(
-                    gsheet, sheetTitle, False, sheetsDict[sheetTitle]['rows'][rowIndex]['cells'][3:6])
-                totalMoviesSize += moviesSize
-                totalMoviesFiles += moviesFile
-                totalMoviesCount += moviesCount
-                moviesName = lstd(
-                    sheetsDict[sheetTitle]['rows'][rowIndex]['cells'][3], 'text')
-                if moviesName != '':
-                    if moviesName in duplicateSheetMovies:
-                        duplicateSheetMovies[moviesName].append(sheetTitle)
-                    else:
-                        duplicateSheetMovies[moviesName] = [sheetTitle]
-                    sheetMoviesData[moviesName] = {
-                        'size': moviesSize,
-                        'files': moviesFile
-                    }
-
-    if sheetTitle == 'Info':
-        # Process the info sheet, requires being last processed
-        seriesCount = len(sheetSeriesData)
-        seriesSize, seriesFiles = 0, 0
-        for name in sheetSeriesData:
-            seriesSize += sheetSeriesData[name]['size']
-            seriesFiles += sheetSeriesData[name]['files']
-
-        moviesCount = len(sheetMoviesData)
-        moviesSize, moviesFiles = 0, 0
-        for name in sheetMoviesData:
-            moviesSize += sheetMoviesData[name]['size']
-            moviesFiles += sheetMoviesData[name]['files']
-
-        wantedTextSeries = str(seriesCount) + ' - ' + str(
-            round(seriesFiles/seriesCount*100)) + '%\n' + str(sizeof_fmt(seriesSize))
-        wantedTextMovies = str(moviesCount) + ' - ' + str(
-            round(moviesFiles/moviesCount*100)) + '%\n' + str(sizeof_fmt(moviesSize))
-
-        if sheetsDict[sheetTitle]['rows'][1]['cells'][0]['text'] != wantedTextSeries:
-            WriteSheet(gsheet, sheetTitle, 'update', 'A2:B2', wantedTextSeries)
-
-        if sheetsDict[sheetTitle]['rows'][1]['cells'][2]['text'] != wantedTextMovies:
-            WriteSheet(gsheet, sheetTitle, 'update', 'C2:D2', wantedTextMovies)
+    # Empty cells and rows are left out of the response, fill them in up to the sheets size
+    rowData = rowData + [{}] * (rowCount - startRow - len(rowData))
+    return [SheetRow(row, startRow + y, startColumn, usedColumnCount)
+            for y, row in enumerate(rowData)]
+
+
+def PlanSpreadsheet(gspreadsheet, sheetsData, worksheets, write=False):
+    """Process the users sheets of the spreadsheet against the sites data at once in any order, buffering any changes to write with ApplySpreadsheet
+    write, send each users sheets writes as soon as it is processed rather than waiting for ApplySpreadsheet
+    Returns the info sheets worksheet and rows if due a refresh, else None, and the series/movies on the users sheets, for PlanInfoSheets
+    """
+    userSheets = [sheet for sheet in sheetsData['sheets'] if sheet['properties']['title'] != 'Info']
+    infoSheets = [sheet for sheet in sheetsData['sheets'] if sheet['properties']['title'] == 'Info']
+
+    # Merged in the sheets order, so the sheets duplicates are listed on are in order
+    sheetMedia = {True: {}, False: {}}
+    with ThreadPoolExecutor(sheetWorkers) as pool:
+        futures = []
+        for sheet in userSheets:
+            print(Fore.YELLOW + 'Sheet: ' + gspreadsheet.title + ' - ' +
+                  sheet['properties']['title'] + Style.RESET_ALL)
+            futures.append(pool.submit(write and SyncSheet or PlanSheet, worksheets[sheet['properties']['sheetId']],
+                                       sheet['properties']['title'], SheetRows(sheet)))
+        for future in futures:
+            MergeSheetMedia(sheetMedia, future.result())
+
+    if len(infoSheets) > 0 and InfoDue(gspreadsheet):
+        return (worksheets[infoSheets[0]['properties']['sheetId']], SheetRows(infoSheets[0])), sheetMedia
+    return None, sheetMedia
+
+
+def ApplySpreadsheet(worksheets):
+    """Send the buffered writes of every sheet of the spreadsheet, each sheets writes at once
+    The sonarr/radarr changes are made with ApplyArrChanges once every spreadsheet is done
+    """
+    FlushSheets(worksheets.values())
+
+    # Store the row fingerprints for the next run
+    SaveCache()
+
+
+def StreamPages(gsheet, columnCount):
+    """Download the used columns of a sheet streamPageRows rows at a time up to the sheets size, yielding each page as a list of SheetRow"""
+    for pageStart in range(0, gsheet.row_count, streamPageRows):
+        pageEnd = min(pageStart + streamPageRows, gsheet.row_count)
+        start = time.time()
+        params = {
+            "spreadsheetId": gsheet.spreadsheet.id,
+            "includeGridData": True,
+            "ranges": ["'" + gsheet.title.replace("'", "''") + "'!A" + str(pageStart + 1) + ':' +
+                       n2a(columnCount - 1) + str(pageEnd)],
+            "fields": sheetsFields
+        }
+        data = CallSheets('read', gsheet.spreadsheet._spreadsheets_get, params)['sheets'][0]['data'][0]
+        AddPhaseTime('read', start)
+
+        # Empty cells and rows are left out of the response, fill them in up to the end of the page
+        startRow = lstd(data, 'startRow', pageStart)
+        rowData = lstd(data, 'rowData', [])
+        rowData = rowData + [{}] * (pageEnd - startRow - len(rowData))
+        yield [SheetRow(row, startRow + y, lstd(data, 'startColumn', 0), columnCount)
+               for y, row in enumerate(rowData)]
+
+
+def PrefetchPages(gspreadsheet, sheetTitle, pages):
+    """Search for the new titles on each page of rows before passing it on"""
+    for rows in pages:
+        PrefetchLookups(list(RowSearches(gspreadsheet, sheetTitle, rows).values()))
+        yield rows
+
+
+def FlushPages(gsheet, pages):
+    """Yield the rows of each page, sending the writes buffered for a page once its rows are processed"""
+    for rows in pages:
+        yield from rows
+        FlushSheet(gsheet, gsheet.title)
+
+
+def StreamSheet(gspreadsheet, gsheet):
+    """Process and write a users sheet a page of rows at a time, returns the series/movies on the sheet"""
+    pages = PrefetchPages(gspreadsheet, gsheet.title, StreamPages(gsheet, mediaColumnCount))
+    return PlanSheet(gsheet, gsheet.title, FlushPages(gsheet, pages))
+
+
+def StreamSpreadsheet(gspreadsheet):
+    """Process and write the users sheets of the spreadsheet a page of rows at a time
+    Only the series/movies found on the users sheets are kept between pages, for the info sheet
+    Returns the info sheets worksheet and rows if due a refresh, else None, and the series/movies on the users sheets, for PlanInfoSheets
+    """
+    worksheets = {worksheet.id: worksheet for worksheet in CallSheets('read', gspreadsheet.worksheets)}
+    userSheets = [gsheet for gsheet in worksheets.values() if gsheet.title != 'Info']
+    infoSheets = [gsheet for gsheet in worksheets.values() if gsheet.title == 'Info']
+
+    sheetMedia = {True: {}, False: {}}
+    with ThreadPoolExecutor(sheetWorkers) as pool:
+        futures = []
+        for gsheet in userSheets:
+            print(Fore.YELLOW + 'Sheet: ' + gspreadsheet.title + ' - ' +
+                  gsheet.title + Style.RESET_ALL)
+            futures.append(pool.submit(StreamSheet, gspreadsheet, gsheet))
+        for future in futures:
+            MergeSheetMedia(sheetMedia, future.result())
+
+    ApplySpreadsheet(worksheets)
+    if len(infoSheets) > 0 and InfoDue(gspreadsheet):
+        rows = [row for page in StreamPages(infoSheets[0], infoColumnCount) for row in page]
+        return (infoSheets[0], rows), sheetMedia
+    return None, sheetMedia
+
+
+def SyncSheets(gspreadsheet):
+    """Process the users sheets of the spreadsheet against the sites data and write any changes, returns the same as PlanSpreadsheet"""
+    if syncOptions['streamSync']:
+        return StreamSpreadsheet(gspreadsheet)
+    sheetsData, worksheets = FetchSpreadsheet(gspreadsheet)
+    planned = PlanSpreadsheet(gspreadsheet, sheetsData, worksheets, write=True)
+    ApplySpreadsheet(worksheets)
+    return planned
+
+
+#################################
+########### WEBHOOKS ############
+#################################
+
+# Webhook events waiting to be processed, as instance, site id and if deleted
+webhookQueue = queue.Queue()
+
+# Webhook event types that change what the sheets show
+webhookEvents = {'Grab', 'Download', 'SeriesDelete', 'EpisodeFileDelete',
+                 'MovieDelete', 'MovieFileDelete'}
+
+
+def WebhookAuthorised(authorization):
+    """Check a webhooks Authorization header against the webhook login in credentials.json, any is accepted without one"""
+    login = lstd(credentials, 'webhook', None)
+    if login is None:
+        return True
+    expected = 'Basic ' + base64.b64encode((login['authuser'] + ':' + login['authpass']).encode()).decode()
+    return hmac.compare_digest(authorization.encode(), expected.encode())
+
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+    """Queues sonarr/radarr webhook events to refresh the rows they affect"""
+
+    def do_POST(self):
+        if not WebhookAuthorised(self.headers.get('Authorization', '')):
+            self.send_response(401)
+            self.send_header('WWW-Authenticate', 'Basic realm="sheetarr"')
+            self.end_headers()
+            return
+        try:
+            payload = json.loads(self.rfile.read(
+                int(self.headers.get('Content-Length', 0))))
+        except ValueError:
+            self.send_response(400)
+            self.end_headers()
+            return
+
+        eventType = lstd(payload, 'eventType')
+        isSeries = 'series' in payload
+        item = lstd(payload, isSeries and 'series' or 'movie', {})
+        if eventType in webhookEvents and 'id' in item:
+            # The instance is named in the path, or in the payload by newer versions
+            instance = GetInstance(isSeries, self.path.strip('/') or lstd(payload, 'instanceName'))
+            webhookQueue.put((instance, item['id'], eventType in {
+                             'SeriesDelete', 'MovieDelete'}))
+        self.send_response(200)
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def GetRowCells(gsheet, rowIndexes, isSeries):
+    """Get the cell data of the series or movie cells for rows of a sheet, by row index"""
+    startColumn = 0 if isSeries else 3
+    sheetRanges = ["'" + gsheet.title.replace("'", "''") + "'!" + n2a(startColumn) + str(
+        rowIndex + 1) + ':' + n2a(startColumn + 2) + str(rowIndex + 1) for rowIndex in rowIndexes]
+    params = {
+        "spreadsheetId": gsheet.spreadsheet.id,
+        "includeGridData": True,
+        "ranges": sheetRanges,
+        "fields": sheetsFields
+    }
+    rowCells = {}
+    for data in CallSheets('read', gsheet.spreadsheet._spreadsheets_get, params)['sheets'][0]['data']:
+        rowIndex = lstd(data, 'startRow', 0)
+        rowCells[rowIndex] = SheetRow(
+            lstd(data, 'rowData', [{}])[0], rowIndex, startColumn, 3)[0:3]
+    return rowCells
+
+
+def RefreshMedia(instance, itemId, deleted):
+    """Update a series/movie from a sonarr/radarr instance and refresh the sheet rows it is on"""
+    start = time.time()
+    isSeries = instance['isSeries']
+    item = ([siteItem for siteItem in instance['list'] if siteItem['id'] == itemId] or [None])[0]
+    if not deleted:
+        item = GetArr(instance, (isSeries and 'series/' or 'movie/') + str(itemId))
+    if item is None:
+        return
+
+    # Replace the item in the sites data
+    UpdateLibraryItem(instance, itemId, not deleted and item or None)
+
+    # Find the rows matched to the item, or by any title it has for rows planned before it was on the sites, grouped by sheet
+    sheetRows = {}
+    for rowsKey in [(instance['name'], itemId)] + [(isSeries, key) for key in set(TitleKeys(item))]:
+        for gsheet, rowIndex in lstd(sheetMediaRows, rowsKey, []):
+            sheetRows.setdefault(BufferKey(gsheet), (gsheet, set()))[1].add(rowIndex)
+
+    for gsheet, rowIndexes in sheetRows.values():
+        print(Fore.YELLOW + 'Refreshing ' + item['title'] + ' on ' + gsheet.title + Style.RESET_ALL)
+        for rowIndex, cellData in GetRowCells(gsheet, sorted(rowIndexes), isSeries).items():
+            ProcessSheetMedia(gsheet, gsheet.title, isSeries, cellData)
+        FlushSheet(gsheet, gsheet.title)
+    ApplyArrChanges()
+    SaveCache()
+    AddPhaseTime('webhook', start)
+
+
+#################################
+############## RUN ##############
+#################################
+
+# Set to stop the daemon after the current sync
+daemonStop = threading.Event()
+
+
+def StartSync():
+    """Start a sync, clearing the last syncs data and refreshing the sonarr/radarr libraries"""
+    quotaWaits.clear()
+    sheetMediaRows.clear()
+    renderCache.clear()
+    PruneCache()
+    RefreshLibrary()
+
+
+# Options of the engine running, set by SheetarrEngine from the settings above and its arguments
+syncOptions = {'incrementalSync': incrementalSync, 'removeMissing': removeMissing, 'streamSync': streamSync}
+
+
+class SheetarrEngine:
+    """Runs syncs in stages, so the daemon, tools and benchmarks can drive them in process
+    LoadConfig, read the credentials, set up the sonarr/radarr instances and open the cache, without connecting to anything
+    Fetch, authorise google sheets, refresh the sonarr/radarr libraries and download every spreadsheets data
+    Plan, process every users sheet against the libraries, then the info sheets from every spreadsheet, buffering the writes and queueing the sonarr/radarr changes
+    Changes, get the planned changes to save as json, and LoadPlan to load them again
+    Apply, send the buffered writes and make the sonarr/radarr changes
+    Sync, all of the stages, each spreadsheet in its own worker
+
+    full, process every row, including rows unchanged since the last run
+    remove, queue series/movies on no sheet to remove, asking before each
+    stream, read and write the users sheets a page of rows at a time when syncing
+    """
+
+    def __init__(self, configFile='credentials.json', full=False, remove=False, stream=False):
+        self.configFile = configFile
+        self.options = {
+            'incrementalSync': incrementalSync and not full,
+            'removeMissing': removeMissing or remove,
+            'streamSync': streamSync or stream
+        }
+        # Fetched data of each spreadsheet, as the spreadsheet, sheets data and worksheets by id
+        self.fetched = []
+
+    def LoadConfig(self):
+        LoadConfig(self.configFile)
+        syncOptions.update(self.options)
+        return self
+
+    def Fetch(self):
+        self.LoadConfig()
+        Authorise()
+        StartSync()
+        self.fetched = [(gspreadsheet,) + FetchSpreadsheet(gspreadsheet)
+                        for gspreadsheet in spreadsheets]
+        return self
+
+    def Plan(self):
+        self.LoadConfig()
+        PlanInfoSheets([(gspreadsheet, PlanSpreadsheet(gspreadsheet, sheetsData, worksheets))
+                        for gspreadsheet, sheetsData, worksheets in self.fetched])
+        return self
+
+    def Changes(self):
+        return PlannedChanges()
+
+    def LoadPlan(self, plan):
+        self.LoadConfig()
+        LoadPlan(plan)
+        return self
+
+    def Apply(self):
+        FlushAll()
+        ApplyArrChanges()
+        SaveCache()
+        self.fetched = []
+        return self
+
+    def Sync(self, interval=daemonInterval):
+        """Sync sonarr/radarr with every spreadsheet once, each spreadsheet in its own worker
+        interval, the seconds until the next sync, warned about if the sync gets close to it
+        """
+        start = time.time()
+        self.LoadConfig()
+        Authorise()
+        StartSync()
+
+        planned = []
+        with ThreadPoolExecutor(len(spreadsheets)) as pool:
+            futures = {pool.submit(SyncSheets, gspreadsheet): gspreadsheet
+                       for gspreadsheet in spreadsheets}
+            for future in as_completed(futures):
+                try:
+                    planned.append((futures[future], future.result()))
+                except Exception as error:
+                    PostDiscord(Fore.RED, 'Sync failed for ' +
+                                futures[future].title, repr(error))
+        # The info sheets need every spreadsheet, else the failed ones titles would be missing and could be removed
+        if len(planned) == len(spreadsheets):
+            PlanInfoSheets(planned)
+            FlushAll()
+        ApplyArrChanges()
+        SaveCache()
+        for bucket, waited in quotaWaits.items():
+            if waited > 0:
+                print(Fore.YELLOW + 'Waited ' + str(round(waited, 1)) + 's for sheets ' +
+                      bucket + ' quota' + Style.RESET_ALL)
+        runSeconds = time.time() - start
+        print(Fore.YELLOW + 'Synced in ' + str(round(runSeconds, 1)) + 's' + Style.RESET_ALL)
+        WriteMetrics(runSeconds, interval)
+
+    def Health(self):
+        """Check the cache, sonarr/radarr and google sheets can be reached, printing each result, returns True if all are healthy"""
+        self.LoadConfig()
+        checks = [('Cache', lambda: QueryCache('SELECT 1'))]
+        for instance in sonarrInstances + radarrInstances:
+            checks.append((instance['name'].capitalize(),
+                           lambda instance=instance: GetArr(instance, 'system/status')))
+        checks.append(('Google sheets', lambda: [CallSheets('read', gspreadsheet.worksheets)
+                                                  for gspreadsheet in Authorise()]))
+        healthy = True
+        for name, check in checks:
+            try:
+                check()
+                print(Fore.GREEN + name + ' OK' + Style.RESET_ALL)
+            except Exception as error:
+                healthy = False
+                print(Fore.RED + name + ' FAILED ' + repr(error) + Style.RESET_ALL)
+        return healthy
+
+
+def RunDaemon(engine):
+    """Keep syncing on an interval until stopped with SIGINT or SIGTERM, reusing the authorised clients
+    Between syncs, rows are refreshed as sonarr/radarr webhook events arrive
+    """
+    interval = float(GetArgument(['--interval'], daemonInterval))
+    jitter = float(GetArgument(['--jitter'], daemonJitter))
+    port = int(GetArgument(['--webhook'], webhookPort))
+    host = GetArgument(['--webhook-host'], webhookHost)
+    metricsServerPort = int(GetArgument(['--metrics'], metricsPort))
+
+    def Stop(signum, frame):
+        print(Fore.YELLOW + 'Stopping after the current sync' + Style.RESET_ALL)
+        daemonStop.set()
+
+    signal.signal(signal.SIGINT, Stop)
+    signal.signal(signal.SIGTERM, Stop)
+
+    webhookServer = None
+    if port:
+        webhookServer = http.server.ThreadingHTTPServer((host, port), WebhookHandler)
+        threading.Thread(target=webhookServer.serve_forever, daemon=True).start()
+        print(Fore.YELLOW + 'Listening for webhooks on ' + (host or 'every address') + ' port ' + str(port) + Style.RESET_ALL)
+        if host not in ('127.0.0.1', 'localhost', '::1') and lstd(credentials, 'webhook', None) is None:
+            print(Fore.RED + 'Webhooks are accepted from other machines without a login, add one to credentials.json' + Style.RESET_ALL)
+
+    metricsServer = None
+    if metricsServerPort:
+        metricsServer = http.server.ThreadingHTTPServer(('', metricsServerPort), MetricsHandler)
+        threading.Thread(target=metricsServer.serve_forever, daemon=True).start()
+        print(Fore.YELLOW + 'Serving metrics on port ' + str(metricsServerPort) + Style.RESET_ALL)
+
+    while not daemonStop.is_set():
+        nextSync = time.time() + interval + random.uniform(0, jitter)
+        try:
+            engine.Sync(interval)
+        except Exception as error:
+            PostDiscord(Fore.RED, 'Sync failed', repr(error))
+
+        # Refresh rows from webhook events until the next sync, waking every second to check if stopped
+        while not daemonStop.is_set() and time.time() < nextSync:
+            try:
+                event = webhookQueue.get(timeout=min(1, max(0, nextSync - time.time())))
+            except queue.Empty:
+                continue
+            try:
+                RefreshMedia(*event)
+            except Exception as error:
+                PostDiscord(Fore.RED, 'Webhook refresh failed', repr(error))
+
+    if webhookServer:
+        webhookServer.shutdown()
+    if metricsServer:
+        metricsServer.shutdown()
+
+
+usage = """Sync google sheets with sonarr and radarr, adding requested series/movies and showing their status
+Usage: python3 sheetarr.py [options]
+  -h, --help          Show this help
+  --config FILE       Read the credentials from FILE instead of credentials.json
+  -f, --full          Process every row, including rows unchanged since the last run
+  -r, --remove        Ask to remove series/movies that are not on any sheet once the changes are made
+  --stream            Read and write the users sheets a page of rows at a time, to keep memory flat for large sheets
+  --plan              Work out the changes without making them, saving them to FILE given with --plan-file, or plan.json
+  --apply FILE        Make the changes saved by --plan, to apply a plan made at a quieter time
+  --health            Check the cache, sonarr/radarr and google sheets can be reached, exiting with 1 if not
+  -d, --daemon        Keep syncing on an interval until stopped
+  --interval SECONDS  Seconds between syncs in daemon mode
+  --jitter SECONDS    Most random extra seconds added to each interval
+  --webhook PORT      Port to accept sonarr/radarr webhooks on in daemon mode
+  --webhook-host HOST Address to accept webhooks on, 127.0.0.1 by default, '' for every address
+  --metrics PORT      Port to serve prometheus metrics on at /metrics in daemon mode
+"""
+
+
+def Main():
+    """Run from the command line"""
+    global discordVerbosity
+    if '--help' in sys.argv or '-h' in sys.argv:
+        print(usage)
+        return
+    engine = SheetarrEngine(GetArgument(['--config'], 'credentials.json'),
+                            full='--full' in sys.argv or '-f' in sys.argv,
+                            remove='--remove' in sys.argv or '-r' in sys.argv,
+                            stream='--stream' in sys.argv)
+    if '--health' in sys.argv:
+        sys.exit(not engine.Health() and 1 or 0)
+    if engine.options['removeMissing'] and ('--daemon' in sys.argv or '-d' in sys.argv):
+        print(Fore.RED + 'Removing asks before each series/movie, so it cannot be used with --daemon' + Style.RESET_ALL)
+        sys.exit(2)
+    if '--plan' in sys.argv:
+        # Nothing is sent to discord until the plan is applied
+        discordVerbosity = 0
+        plan = engine.Fetch().Plan().Changes()
+        planPath = GetArgument(['--plan-file'], planFile)
+        with open(planPath, 'w') as json_file:
+            json.dump(plan, json_file, indent=2)
+        print(Fore.YELLOW + 'Planned ' + str(len(plan['writes'])) + ' cell writes in ' + str(plan['quota']['write']) +
+              ' requests and ' + str(len(plan['arr'])) + ' sonarr/radarr changes, saved to ' + planPath + Style.RESET_ALL)
+    elif '--apply' in sys.argv:
+        with open(GetArgument(['--apply'], planFile)) as json_file:
+            engine.LoadPlan(json.load(json_file)).Apply()
+    elif '--daemon' in sys.argv or '-d' in sys.argv:
+        RunDaemon(engine.LoadConfig())
     else:
-        # First row, push the total sizes to the sheet
-        wantedTextSeries = totalSeriesCount == 0 and 'N/A' or str(totalSeriesCount) + ' - ' + str(
-            round(totalSeriesFiles/totalSeriesCount*100)) + '%\n' + str(sizeof_fmt(totalSeriesSize))
-        wantedTextMovies = totalMoviesCount == 0 and 'N/A' or str(totalMoviesCount) + ' - ' + str(
-            round(totalMoviesFiles/totalMoviesCount*100)) + '%\n' + str(sizeof_fmt(totalMoviesSize))
+        engine.Sync()
+    # Finish sending discord messages before exiting
+    WaitDiscord()
 
-        if sheetsDict[sheetTitle]['rows'][0]['cells'][2]['text'] != wantedTextSeries:
-            WriteSheet(gsheet, sheetTitle, 'update', 'C1', wantedTextSeries)
 
-        if sheetsDict[sheetTitle]['rows'][0]['cells'][5]['text'] != wantedTextMovies:
-            WriteSheet(gsheet, sheetTitle, 'update', 'F1', wantedTextMovies)
+if __name__ == '__main__':
+    Main()